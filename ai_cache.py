@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import unicodedata
+
+from cache import DelayedSave, TTLCache
+
+# 归一化时去掉的标点、空白，以及句尾的语气词
+_NOISE = re.compile(r'[\s\W_]+')
+_PARTICLES = re.compile(r'[吗呢吧啊呀哦嘛]+$')
+
+
+def normalize_question(text):
+    """归一化访客问题，使仅有大小写、全半角、标点差异的问题得到相同的键"""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    return _PARTICLES.sub('', _NOISE.sub('', text))
+
+
+class AnswerCache:
+    """AI 回复缓存
+
+    以 (系统提示哈希, 归一化后的问题) 为键，带过期时间和数量上限（LRU 淘汰），
+    配置了 path 时会持久化到磁盘，重启后继续使用；变更在 save_delay 秒后于线程池中批量写入。
+
+    Args:
+        payload: 系统提示内容，变化后旧的缓存自动失效
+        ttl: 缓存有效期（秒）
+        max_size: 最多缓存的回复数
+        path: 持久化文件路径，为 None 时只保存在内存
+        save_delay: 变更写入磁盘前的等待时间（秒）
+    """
+
+    def __init__(self, payload, ttl=86400, max_size=1000, path=None, save_delay=5):
+        self._payload_hash = hashlib.sha1((payload or '').encode('utf-8')).hexdigest()[:16]
+        self.ttl = ttl
+        self._path = path
+        self._cache = TTLCache(maxsize=max_size, ttl=ttl)
+        self._saver = DelayedSave(self._entries, self._write, save_delay)
+        self._load()
+
+    def _key(self, question):
+        normalized = normalize_question(question)
+        if not normalized:
+            return None
+        return f"{self._payload_hash}:{normalized}"
+
+    def get(self, question):
+        key = self._key(question)
+        if key is None:
+            return None
+        entry = self._cache.get(key)
+        return entry[0] if entry is not None else None
+
+    def put(self, question, answer):
+        key = self._key(question)
+        if key is None or not answer:
+            return
+        self._cache.set(key, (answer, time.time()))
+        self._save()
+
+    def warm(self, faq):
+        """使用 FAQ 预热缓存
+
+        Args:
+            faq: [(问题, 回复), ...]
+        """
+        for question, answer in faq:
+            key = self._key(question)
+            if key is not None and answer:
+                self._cache.set(key, (answer, time.time()))
+        self._save()
+
+    def clear(self):
+        self._cache.clear()
+        self._save()
+
+    def stats(self):
+        return self._cache.stats()
+
+    def _load(self):
+        if not self._path:
+            return
+        try:
+            with open(self._path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.error(f"加载 AI 回复缓存失败: {str(e)}")
+            return
+
+        now = time.time()
+        for key, answer, created in entries:
+            remaining = self.ttl - (now - created) if self.ttl else None
+            if remaining is None or remaining > 0:
+                self._cache.set(key, (answer, created), ttl=remaining)
+
+    def _save(self):
+        if self._path:
+            self._saver.mark()
+
+    async def flush(self):
+        """立即写入尚未保存的变更"""
+        await self._saver.flush()
+
+    def _entries(self):
+        return [[key, answer, created] for key, (answer, created) in self._cache.items()]
+
+    def _write(self, entries):
+        try:
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_path = self._path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(temp_path, self._path)
+        except Exception as e:
+            logging.error(f"保存 AI 回复缓存失败: {str(e)}")
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import re
+from collections import deque
+from functools import lru_cache
+
+from cache import TTLCache
+
+_CJK = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text):
+    """估算文本的 token 数：中文约一字一个 token，其余约四个字符一个 token"""
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class ConversationMemory:
+    """按会话保存最近的对话轮次，供 AI 回复时拼接上下文
+
+    每个会话是一个固定长度的环形缓冲区，内存中只保留最近活跃的 max_sessions 个会话，
+    其余的在需要时从会话存储中读取。
+    对话记录的变更先记在内存中，flush_delay 秒后在线程池中批量写入存储，
+    同一会话在这段时间内的多轮对话只写一次；尚未写入的会话即使被 LRU 淘汰也会在批量写入时保存。
+
+    Args:
+        store: 会话存储（需实现 load_history / save_histories），为 None 时只保存在内存
+        max_turns: 每个会话保留的最大轮次
+        token_budget: 拼接上下文时（包括系统提示和当前问题）允许使用的 token 上限
+        max_sessions: 内存中保留的会话数
+        flush_delay: 变更写入存储前的等待时间（秒）
+    """
+
+    def __init__(self, store=None, max_turns=20, token_budget=2000, max_sessions=1000, flush_delay=5):
+        self._store = store
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.flush_delay = flush_delay
+        self._buffers = TTLCache(maxsize=max_sessions)
+        # 待写入的变更：{session_id: 环形缓冲区}，None 表示删除
+        self._pending = {}
+        # 正在写入存储的一批变更
+        self._writing = {}
+        self._flush_handle = None
+        self._flush_task = None
+
+    def _buffer(self, session_id):
+        buffer = self._buffers.get(session_id)
+        if buffer is None:
+            turns = []
+            # 已被淘汰但还没写入存储的会话，使用内存中的记录
+            if session_id in self._pending:
+                turns = self._pending[session_id] or []
+            elif session_id in self._writing:
+                turns = self._writing[session_id] or []
+            elif self._store is not None:
+                try:
+                    turns = self._store.load_history(session_id)
+                except Exception as e:
+                    logging.error(f"读取对话记录失败: {str(e)}")
+            buffer = deque(turns, maxlen=self.max_turns)
+            self._buffers.set(session_id, buffer)
+        return buffer
+
+    def append(self, session_id, role, content):
+        """记录一轮对话，role 为 user（访客）或 assistant（人工/AI 客服）"""
+        if not content:
+            return
+        buffer = self._buffer(session_id)
+        buffer.append((role, content))
+        self._mark(session_id, buffer)
+
+    def _mark(self, session_id, buffer):
+        if self._store is None:
+            return
+        self._pending[session_id] = buffer
+        if self._flush_handle is not None or (self._flush_task is not None and not self._flush_task.done()):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 不在事件循环中（例如脚本调用）时直接写入
+            self._write(self._take_pending())
+            self._writing = {}
+            return
+        self._flush_handle = loop.call_later(self.flush_delay, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.ensure_future(self.flush())
+
+    def _take_pending(self):
+        self._writing = {
+            session_id: (list(buffer) if buffer is not None else None)
+            for session_id, buffer in self._pending.items()
+        }
+        self._pending.clear()
+        return self._writing
+
+    def _write(self, batch):
+        try:
+            self._store.save_histories(batch)
+        except Exception as e:
+            logging.error(f"保存对话记录失败: {str(e)}")
+
+    async def flush(self):
+        """在线程池中把待写入的变更批量写入存储"""
+        while self._pending:
+            batch = self._take_pending()
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write, batch)
+            finally:
+                self._writing = {}
+
+    def messages(self, session_id, system_prompt, question):
+        """拼接发送给模型的消息列表，超出 token 预算时从最早的轮次开始丢弃"""
+        budget = self.token_budget - count_tokens(system_prompt) - count_tokens(question)
+        history = []
+        for role, content in reversed(self._buffer(session_id)):
+            budget -= count_tokens(content)
+            if budget < 0:
+                break
+            history.append({"role": role, "content": content})
+        history.reverse()
+        return [{"role": "system", "content": system_prompt}, *history, {"role": "user", "content": question}]
+
+    def evict(self, session_id):
+        """会话结束时清除对话记录"""
+        self._buffers.pop(session_id)
+        self._mark(session_id, None)
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import time
+
+from metrics import REGISTRY
+from tracing import span
+
+TRANSCODE_SECONDS = REGISTRY.histogram('crispbot_audio_transcode_seconds', '音频下载 + 转码耗时（秒）', ('result',))
+
+
+class AudioTranscoder:
+    """流式音频转码：边下载边通过 ffmpeg 转换为 Telegram 语音使用的 OGG/Opus
+
+    下载的数据块直接写入 ffmpeg 的标准输入，转码结果从标准输出读取，
+    不落地临时文件，也不会在 Python 中解码整段音频。
+
+    Args:
+        http: 共用的 HttpClient
+        max_concurrency: 同时进行的转码数量上限
+        timeout: 单次下载 + 转码的超时时间（秒）
+        bitrate: Opus 输出码率
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, http, max_concurrency=2, timeout=60, bitrate='32k'):
+        self._http = http
+        self._max_concurrency = max_concurrency
+        self._semaphore = None
+        self._timeout = timeout
+        self._bitrate = bitrate
+
+    async def transcode_url(self, url):
+        """下载并转码音频，返回 OGG/Opus 字节"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        async with self._semaphore:
+            started = time.monotonic()
+            result = 'error'
+            try:
+                with span('audio.transcode'):
+                    output = await asyncio.wait_for(self._transcode(url), timeout=self._timeout)
+                result = 'ok'
+                return output
+            finally:
+                TRANSCODE_SECONDS.observe(time.monotonic() - started, result=result)
+
+    async def _transcode(self, url):
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            '-i', 'pipe:0',
+            '-vn', '-c:a', 'libopus', '-b:a', self._bitrate,
+            '-f', 'ogg', 'pipe:1',
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+
+        async def feed():
+            try:
+                async with self._http.stream('GET', url, timeout=self._timeout) as response:
+                    if response.status != 200:
+                        raise Exception(f"下载音频失败，状态码: {response.status}")
+                    async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+                        process.stdin.write(chunk)
+                        await process.stdin.drain()
+            finally:
+                if not process.stdin.is_closing():
+                    process.stdin.close()
+
+        try:
+            _, output, error = await asyncio.gather(
+                feed(),
+                process.stdout.read(),
+                process.stderr.read()
+            )
+            await process.wait()
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+
+        if process.returncode != 0 or not output:
+            raise Exception(f"ffmpeg 转码失败: {error.decode(errors='ignore').strip()}")
+        logging.info(f"音频转码完成，输出 {len(output)} 字节")
+        return output
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+
+from cache import TTLCache
+
+
+class GapBackfill:
+    """RTM 断线期间的消息补发
+
+    平时记录每个会话最后收到的访客消息时间；断线重连后，对最近活跃的会话以及断线期间有更新的会话，
+    通过 Crisp REST 接口分页拉取断线期间的访客消息，按时间顺序交给正常的转发流程处理
+    （转发流程中的 fingerprint 去重会跳过已经送达的消息）。
+
+    Args:
+        crisp: AsyncCrisp 客户端
+        website_id: Crisp 网站 ID
+        forward: (event) -> bool，正常的消息转发入口，返回 False 表示事件是重复的已被忽略
+        lookback: 记录会话最后消息时间的时长（秒），也是补发的最远时间范围
+        grace: 没有记录过的会话从断线前多少秒开始检查（秒），覆盖断线被发现之前的空窗
+        max_sessions: 最多记录的活跃会话数
+        max_pages: 每个会话（以及会话列表）最多拉取的页数
+        max_concurrency: 同时拉取消息的会话数
+    """
+
+    def __init__(self, crisp, website_id, forward, lookback=3600, grace=30, max_sessions=1000,
+                 max_pages=5, max_concurrency=4):
+        self._crisp = crisp
+        self._website_id = website_id
+        self._forward = forward
+        self.lookback = lookback
+        self.grace = grace
+        self.max_pages = max_pages
+        self._max_concurrency = max_concurrency
+        self._last_seen = TTLCache(maxsize=max_sessions, ttl=lookback)
+        self._disconnected_at = None
+        self._running = False
+        self.stats = {'runs': 0, 'sessions': 0, 'replayed': 0, 'errors': 0}
+
+    def seen(self, data):
+        """记录会话最后一条访客消息的时间（毫秒时间戳）"""
+        session_id = data.get("session_id")
+        timestamp = data.get("timestamp") or int(time.time() * 1000)
+        if session_id and timestamp > self._last_seen.get(session_id, 0):
+            self._last_seen.set(session_id, timestamp)
+
+    def mark_disconnected(self):
+        # 多次断线只保留第一次的时间，直到补发完成
+        if self._disconnected_at is None:
+            self._disconnected_at = int(time.time() * 1000)
+
+    async def run(self):
+        """重连后调用，补发断线期间遗漏的访客消息"""
+        if self._disconnected_at is None or self._running:
+            return
+        self._running = True
+        disconnected_at, self._disconnected_at = self._disconnected_at, None
+        try:
+            floor = max(disconnected_at - self.grace * 1000, int(time.time() * 1000) - self.lookback * 1000)
+            # 记录过的会话从最后收到的消息之后开始补发，未记录过的会话从断线时间（减去 grace）开始
+            targets = {session_id: max(timestamp, floor) for session_id, timestamp in self._last_seen.items()}
+            for session_id in await self._updated_sessions(floor):
+                targets.setdefault(session_id, floor)
+
+            self.stats['runs'] += 1
+            self.stats['sessions'] += len(targets)
+            semaphore = asyncio.Semaphore(self._max_concurrency)
+
+            async def replay(session_id, since):
+                async with semaphore:
+                    messages = await self._missed_messages(session_id, since)
+                for message in messages:
+                    self._replay(message)
+
+            await asyncio.gather(*(replay(session_id, since) for session_id, since in targets.items()))
+            logging.info(f"断线补发完成：检查 {len(targets)} 个会话，累计补发 {self.stats['replayed']} 条消息")
+        except Exception as e:
+            self.stats['errors'] += 1
+            logging.error(f"断线补发失败: {str(e)}")
+        finally:
+            self._running = False
+
+    async def _updated_sessions(self, since):
+        """断线期间有更新的会话（包括断线期间新建的会话）"""
+        sessions = []
+        date_start = datetime.fromtimestamp(since / 1000, tz=timezone.utc).isoformat()
+        for page in range(1, self.max_pages + 1):
+            try:
+                conversations = await self._crisp.list_conversations(
+                    self._website_id, page,
+                    {"filter_date_start": date_start, "order_date_updated": 1}
+                )
+            except Exception as e:
+                self.stats['errors'] += 1
+                logging.error(f"获取会话列表失败: {str(e)}")
+                break
+            if not conversations:
+                break
+            for conversation in conversations:
+                if conversation.get("updated_at", since) >= since and conversation.get("session_id"):
+                    sessions.append(conversation["session_id"])
+            # 列表按更新时间倒序，出现早于 since 的会话说明后面的页都不需要了
+            if any(conversation.get("updated_at", since) < since for conversation in conversations):
+                break
+        return sessions
+
+    async def _missed_messages(self, session_id, since):
+        """从最新的消息向前翻页，直到早于 since，返回按时间排序的访客消息"""
+        missed = {}
+        timestamp_before = None
+        for _ in range(self.max_pages):
+            query = {"timestamp_before": timestamp_before} if timestamp_before else None
+            try:
+                messages = await self._crisp.get_messages_in_conversation(self._website_id, session_id, query)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logging.error(f"获取会话 {session_id} 的消息失败: {str(e)}")
+                break
+            if not messages:
+                break
+            for message in messages:
+                if message.get("timestamp", 0) > since and message.get("from") == "user":
+                    missed[message.get("fingerprint")] = message
+            oldest = min(message.get("timestamp", 0) for message in messages)
+            if oldest <= since or oldest == timestamp_before:
+                break
+            timestamp_before = oldest
+        return sorted(missed.values(), key=lambda message: message.get("timestamp", 0))
+
+    def _replay(self, message):
+        event = dict(message)
+        event.setdefault("website_id", self._website_id)
+        try:
+            if self._forward(event):
+                self.stats['replayed'] += 1
+        except Exception as e:
+            self.stats['errors'] += 1
+            logging.error(f"补发消息失败: {str(e)}")
@@ -1,19 +1,17 @@
+from startup import timeline, run_probes
 import os
 import yaml
 import logging
-import requests
-import base64
-import io  
 import signal
+import asyncio
 import sys
 import telegram
-import socketio
 
 
-from openai import OpenAI
-from crisp_api import Crisp
+import clients
+import metrics
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.ext import Application, Defaults, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+from telegram.ext import Application, CallbackContext, Defaults, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 from telegram.error import BadRequest
 
 import handler
@@ -42,37 +40,18 @@ nicknames = config.get('nicknames', {
     'system_message': '系统消息'
 })
 
-# Connect Crisp
-try:
-    crispCfg = config['crisp']
-    client = Crisp()
-    client.set_tier("plugin")
-    client.authenticate(crispCfg['id'], crispCfg['key'])
-    client.plugin.get_connect_account()
-    client.website.get_website(crispCfg['website'])
-except Exception as error:
-    logging.warning('无法连接 Crisp 服务，请确认 Crisp 配置项是否正确')
-    exit(1)
+crispCfg = config['crisp']
 
-# Connect OpenAI
-try:
-    openai = OpenAI(api_key=config['openai']['apiKey'], base_url='https://api.openai.com/v1')
-    openai.models.list()  # 测试连接
-except Exception as error:
-    logging.warning('无法连接 OpenAI 服务，智能化回复将不会使用')
-    logging.error(f"OpenAI 连接错误: {str(error)}")  # 添加详细错误日志
-    openai = None
-
-# 修改 socket.io 客户端配置
-sio = socketio.AsyncClient(
-    reconnection=True,
-    reconnection_attempts=5,  # 限制重连次数
-    reconnection_delay=1,     # 初始重连延迟
-    reconnection_delay_max=60,  # 最大重连延迟
-    logger=True,
-    request_timeout=30,       # 请求超时时间
-    handle_sigint=False       # 禁用默认的 SIGINT 处理
-)
+# 共用的 HTTP 连接池和 Crisp 客户端，bot 模块被加载两次时也只创建一次
+http, crisp = clients.init(config)
+
+# OpenAI 客户端在启动检查时创建，未配置 apiKey 时不会加载 openai 库
+openai = None
+
+def createOpenAI():
+    from openai import AsyncOpenAI
+    # 事件循环中使用异步客户端，支持流式输出
+    return AsyncOpenAI(api_key=config['openai']['apiKey'], base_url='https://api.openai.com/v1')
 
 def changeButton(conversation_id, boolean, completed=False):
     return InlineKeyboardMarkup(
@@ -95,31 +74,20 @@ async def onReply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     if msg.chat_id != config['bot']['groupId']:
         return
-        
+
+    # 客服回复同样记录处理时间线，和访客消息一起参与慢消息排行
+    with handler.tracer.trace('reply', topic_id=msg.message_thread_id):
+        await forwardReply(msg)
+
+async def forwardReply(msg):
     try:
         # 检查消息是否有话题ID
         if not msg.message_thread_id:
             logging.warning("消息没有话题ID，可能是在主频道发送")
             return
-        # 先从内存中查找，如果找不到则从文件加载
-        session_id = None
-        for sid, data in context.bot_data.items():
-            if data.get('topicId') == msg.message_thread_id:
-                session_id = sid
-                break
-                
-        if not session_id:
-            # 从文件重新加载映射
-            mapping = handler.load_session_mapping()
-            for sid, data in mapping.items():
-                if data['topic_id'] == msg.message_thread_id:
-                    session_id = sid
-                    # 更新到内存
-                    context.bot_data[sid] = {
-                        'topicId': data['topic_id'],
-                        'enableAI': data.get('enable_ai', False)
-                    }
-                    break
+        # 通过话题查找会话，不在内存中时从存储读取
+        session = handler.session_registry.by_topic(msg.message_thread_id)
+        session_id = session.session_id if session is not None else None
         
         if session_id:
             if msg.text:  # 处理文本消息
@@ -134,19 +102,17 @@ async def onReply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                     }
                 }
                 # 使用找到的 session_id 发送消息
-                client.website.send_message_in_conversation(
+                await crisp.send_message_in_conversation(
                     config['crisp']['website'],
                     session_id,
                     query
                 )
+                handler.ai_memory.append(session_id, "assistant", msg.text)
             elif msg.photo:  # 处理图片消息
                 try:
-                    photo_file = await msg.photo[-1].get_file()
-                    image_bytes = await photo_file.download_as_bytearray()
-
-                    # 使用新的上传函数
+                    # 使用新的上传函数，重复的图片直接复用已上传的链接
                     print("开始上传图片")
-                    image_url = handler.upload_image_to_telegraph(io.BytesIO(image_bytes))
+                    image_url = await handler.upload_telegram_photo(msg.photo[-1])
                     print(f"图片上传成功，URL: {image_url}")
                     
                     markdown_image = f"[![image]({image_url})]({image_url}) \n点击图片可查看高清大图"
@@ -163,7 +129,7 @@ async def onReply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                     }
                     
                     # 使用找到的 session_id 发送消息
-                    client.website.send_message_in_conversation(
+                    await crisp.send_message_in_conversation(
                         config['crisp']['website'],
                         session_id,
                         query
@@ -188,22 +154,17 @@ async def onChange(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         session_id = data[0].split('complete_session_')[1]
         try:
             # 使用 PATCH 请求将对话标记为已完成
-            url = f"https://api.crisp.chat/v1/website/{crispCfg['website']}/conversation/{session_id}/state"
-            auth = base64.b64encode(f"{crispCfg['id']}:{crispCfg['key']}".encode()).decode()
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Basic {auth}",
-                "X-Crisp-Tier": "plugin"
-            }
-            payload = {"state": "resolved"}
-            response = requests.patch(url, json=payload, headers=headers)
-            response.raise_for_status()
+            await crisp.change_conversation_state(crispCfg['website'], session_id, {"state": "resolved"})
+            handler.meta_cache.pop(session_id)
             await query.answer('对话已标记为完成')
             # 更新按钮为 "已完成"
-            session = context.bot_data.get(session_id, {})
-            session["completed"] = True
+            session = handler.session_registry.get(session_id)
+            if session is not None:
+                handler.session_registry.update(session, completed=True)
+            handler.ai_memory.evict(session_id)
+            handler.card_refresher.forget(session_id)
             await query.edit_message_reply_markup(
-                reply_markup=changeButton(session_id, session.get("enableAI", False), completed=True)
+                reply_markup=changeButton(session_id, session is not None and session.enable_ai, completed=True)
             )
         except Exception as error:
             await query.answer('无法标记对话为完成')
@@ -213,22 +174,15 @@ async def onChange(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         session_id = data[0].split('uncomplete_session_')[1]
         try:
             # 使用 PATCH 请求将对话标记为未完成
-            url = f"https://api.crisp.chat/v1/website/{crispCfg['website']}/conversation/{session_id}/state"
-            auth = base64.b64encode(f"{crispCfg['id']}:{crispCfg['key']}".encode()).decode()
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Basic {auth}",
-                "X-Crisp-Tier": "plugin"
-            }
-            payload = {"state": "pending"}  # 或其他合适的状态
-            response = requests.patch(url, json=payload, headers=headers)
-            response.raise_for_status()
+            await crisp.change_conversation_state(crispCfg['website'], session_id, {"state": "pending"})  # 或其他合适的状态
+            handler.meta_cache.pop(session_id)
             await query.answer('已取消完成标记')
             # 更新按钮为 "标记为已完成"
-            session = context.bot_data.get(session_id, {})
-            session["completed"] = False
+            session = handler.session_registry.get(session_id)
+            if session is not None:
+                handler.session_registry.update(session, completed=False)
             await query.edit_message_reply_markup(
-                reply_markup=changeButton(session_id, session.get("enableAI", False), completed=False)
+                reply_markup=changeButton(session_id, session is not None and session.enable_ai, completed=False)
             )
         except Exception as error:
             await query.answer('无法取消完成标记')
@@ -239,19 +193,19 @@ async def onChange(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         if openai is None:
             await query.answer('无法设置此功能')
         else:
-            session = context.bot_data.get(data[0])
-            session["enableAI"] = not eval(data[1])
+            session = handler.session_registry.get(session_id)
+            if session is None:
+                await query.answer('未找到对应的会话')
+                return
+            handler.session_registry.update(session, enable_ai=not eval(data[1]))
             await query.answer()
             try:
                 # 保持完成状态不变
-                completed = False
-                if session_id in context.bot_data:
-                    completed = context.bot_data[session_id].get('completed', False)
                 await query.edit_message_reply_markup(
-                    changeButton(data[0], session["enableAI"], completed=completed)
+                    changeButton(data[0], session.enable_ai, completed=session.completed)
                 )
                 # 发送提示消息给对方
-                if session["enableAI"]:
+                if session.enable_ai:
                     message_content = "客服暂时无法回复您，AI客服已接入"
                 else:
                     message_content = "关闭AI自动回复，人工客服已接入"
@@ -266,7 +220,7 @@ async def onChange(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                         "avatar": handler.avatars.get('system_message', 'https://example.com/system_avatar.png')
                     }
                 }
-                client.website.send_message_in_conversation(
+                await crisp.send_message_in_conversation(
                     config['crisp']['website'],
                     session_id,
                     query
@@ -278,14 +232,14 @@ async def onChange(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 logging.error(error)
 
     # 生成并发送按钮
-    conversation_id = data[0]
-    if 'button_sent' not in context.bot_data.get(conversation_id, {}):
+    session = handler.session_registry.get(session_id)
+    if session is not None and not session.button_sent:
         try:
             await query.message.reply_text(
                 "选择操作：",
-                reply_markup=changeButton(conversation_id, context.bot_data.get(conversation_id, {}).get("enableAI", False))
+                reply_markup=changeButton(session_id, session.enable_ai)
             )
-            context.bot_data.setdefault(conversation_id, {})['button_sent'] = True
+            session.button_sent = True
         except Exception as e:
             logging.error(f"发送按钮消息失败: {str(e)}")
         
@@ -294,30 +248,71 @@ def force_exit(signum, frame):
     print("\n强制退出程序...")
     os._exit(0)
 
+async def checkCrisp():
+    await asyncio.gather(
+        crisp.get_connect_account(),
+        crisp.get_website(crispCfg['website'])
+    )
+
+async def postInit(app):
+    """Bot 初始化完成后并行检查 Crisp 和 OpenAI 连接，随后立即连接 Crisp RTM"""
+    global openai
+    timeline.mark("Telegram Bot 已初始化")
+
+    if config['openai'].get('apiKey'):
+        try:
+            openai = createOpenAI()
+        except Exception as error:
+            logging.warning('无法初始化 OpenAI 客户端，智能化回复将不会使用')
+            logging.error(f"OpenAI 初始化错误: {str(error)}")
+
+    startupCfg = config.get('startup', {})
+    probes = {'Crisp': (checkCrisp(), startupCfg.get('crisp_timeout', 10))}
+    if openai is not None:
+        probes['OpenAI'] = (openai.models.list(), startupCfg.get('openai_timeout', 10))
+    errors = await run_probes(probes)
+
+    if errors.get('OpenAI') is not None:
+        logging.warning('无法连接 OpenAI 服务，智能化回复将不会使用')
+        logging.error(f"OpenAI 连接错误: {str(errors['OpenAI'])}")
+        openai = None
+    handler.openai = openai
+    if errors['Crisp'] is not None:
+        logging.warning('无法连接 Crisp 服务，请确认 Crisp 配置项是否正确')
+        raise RuntimeError(f"Crisp 连接错误: {str(errors['Crisp'])}")
+
+    # 本地指标接口，供 Prometheus 抓取
+    metricsCfg = config.get('metrics', {})
+    if metricsCfg.get('enabled', False):
+        try:
+            await metrics.start_server(metricsCfg.get('host', '127.0.0.1'), metricsCfg.get('port', 9108))
+        except Exception as error:
+            logging.error(f"指标服务启动失败: {str(error)}")
+
+    # RTM 连接会一直保持，放到后台任务中运行
+    app.create_task(handler.exec(CallbackContext(app)), name='RTM')
+
 def main():
     try:
         # 设置信号处理
         signal.signal(signal.SIGINT, force_exit)
         signal.signal(signal.SIGTERM, force_exit)
 
+        timeline.mark("模块加载完成")
         logging.info("正在初始化 Bot...")
-        app = Application.builder().token(config['bot']['token']).defaults(Defaults(parse_mode='HTML')).build()
+        app = (
+            Application.builder()
+            .token(config['bot']['token'])
+            .defaults(Defaults(parse_mode='HTML'))
+            .post_init(postInit)
+            .build()
+        )
         
-        # 加载并同步会话映射
+        # 会话映射不再在启动时全部加载，首次访问时由 session_registry 从存储读取
         try:
-            session_mapping = handler.load_session_mapping()
-            for session_id, data in session_mapping.items():
-                if isinstance(data, dict) and 'topic_id' in data:
-                    app.bot_data[session_id] = {
-                        'topicId': data['topic_id'],
-                        'messageId': data.get('message_id'),
-                        'enableAI': data.get('enable_ai', False),
-                        'first_message': False,  # 设置为 False 避免重复发送提示
-                        'completed': False  # 添加完成状态
-                    }
-                    logging.info(f"已恢复会话映射: {session_id} -> {data['topic_id']}")
+            logging.info(f"会话存储中共有 {handler.session_store.count()} 个会话，将按需加载")
         except Exception as e:
-            logging.error(f"加载会话映射失败: {str(e)}")
+            logging.error(f"读取会话存储失败: {str(e)}")
 
         if os.getenv('RUNNER_NAME') is not None:
             return
@@ -360,7 +355,6 @@ def main():
         app.add_handler(CallbackQueryHandler(callback_handler))
         
         logging.info("正在启动 Bot...")
-        app.job_queue.run_once(handler.exec, 5, name='RTM')
         print("Bot 已启动。按 Ctrl+C 停止。")
         app.run_polling(drop_pending_updates=True)
         
@@ -0,0 +1,121 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """带过期时间的 LRU 缓存
+
+    超过 maxsize 时淘汰最久未使用的条目，ttl 为 None 或 0 时条目永不过期。
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            expires_at, value = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def items(self):
+        """返回未过期条目的快照"""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                (key, value) for key, (expires_at, value) in self._data.items()
+                if expires_at is None or expires_at > now
+            ]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits / total) if total else 0.0
+        }
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._data.get(key)
+        return item is not None and (item[0] is None or item[0] > time.monotonic())
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DelayedSave:
+    """合并短时间内的多次保存
+
+    变更后调用 mark()，delay 秒后在线程池中执行一次写入，期间的多次变更只写一次；
+    不在事件循环中（例如脚本调用）时直接写入。
+
+    Args:
+        snapshot: () -> 数据，在事件循环中调用，返回需要写入的数据副本
+        write: (数据) -> None，在线程池中调用
+        delay: 写入前的等待时间（秒）
+    """
+
+    def __init__(self, snapshot, write, delay=5):
+        self._snapshot = snapshot
+        self._write = write
+        self.delay = delay
+        self._dirty = False
+        self._handle = None
+        self._task = None
+
+    def mark(self):
+        self._dirty = True
+        if self._handle is not None or (self._task is not None and not self._task.done()):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._dirty = False
+            self._write(self._snapshot())
+            return
+        self._handle = loop.call_later(self.delay, self._start)
+
+    def _start(self):
+        self._handle = None
+        self._task = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """在线程池中写入尚未保存的变更"""
+        while self._dirty:
+            self._dirty = False
+            await asyncio.get_running_loop().run_in_executor(None, self._write, self._snapshot())
@@ -0,0 +1,110 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+
+from cache import TTLCache
+
+
+class CardRefresher:
+    """话题信息卡片的合并刷新
+
+    - 内容（文本 + 按钮）与上次发送的哈希一致时跳过编辑
+    - 同一会话在 window 秒内的多次刷新合并为窗口结束时的一次编辑
+    - 编辑在后台任务中进行，refresh() 立即返回，不阻塞访客消息的转发
+
+    Args:
+        render: async (session_id) -> (text, reply_markup)，返回 None 表示无需刷新
+        edit: async (session_id, text, reply_markup) -> bool，返回 False 表示消息实际未变化，
+            返回 None 表示编辑被丢弃（下次刷新时重试）
+        window: 同一会话两次编辑之间的最小间隔（秒）
+        max_sessions: 最多记录的会话数，超出时淘汰最久未刷新的会话（被淘汰的会话下次刷新时会直接编辑）
+    """
+
+    def __init__(self, render, edit, window=10, max_sessions=1000):
+        self._render = render
+        self._edit = edit
+        self.window = window
+        self._hashes = TTLCache(maxsize=max_sessions)
+        # 编辑时间只在 window 内有意义
+        self._last_edit = TTLCache(maxsize=max_sessions, ttl=window)
+        # 等待中或进行中的刷新任务
+        self._pending = {}
+        # 刷新进行中又收到刷新请求的会话，当前刷新结束后再检查一次
+        self._again = set()
+        self.stats = {'sent': 0, 'skipped': 0, 'coalesced': 0, 'dropped': 0}
+
+    @staticmethod
+    def digest(text, reply_markup=None):
+        markup = reply_markup.to_dict() if reply_markup is not None else None
+        raw = json.dumps([text, markup], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def remember(self, session_id, text, reply_markup=None):
+        """记录已发送的卡片内容（例如新建话题时直接发送的卡片）"""
+        self._hashes.set(session_id, self.digest(text, reply_markup))
+        self._last_edit.set(session_id, time.monotonic())
+
+    def forget(self, session_id):
+        """会话结束时清除记录"""
+        self._hashes.pop(session_id)
+        self._last_edit.pop(session_id)
+        self._again.discard(session_id)
+        task = self._pending.pop(session_id, None)
+        if task is not None:
+            task.cancel()
+
+    def refresh(self, session_id):
+        """请求刷新卡片，立即返回"""
+        # 已有等待中或进行中的刷新，本次直接合并
+        if session_id in self._pending:
+            self.stats['coalesced'] += 1
+            self._again.add(session_id)
+            return
+        if self._schedule(session_id) > 0:
+            self.stats['coalesced'] += 1
+
+    def _schedule(self, session_id):
+        wait = max(0, self._last_edit.get(session_id, 0) + self.window - time.monotonic())
+        self._pending[session_id] = asyncio.create_task(self._deferred(session_id, wait))
+        return wait
+
+    async def _deferred(self, session_id, wait):
+        try:
+            await asyncio.sleep(wait)
+            # 等待期间的刷新请求由本次刷新覆盖
+            self._again.discard(session_id)
+            await self._run(session_id)
+        finally:
+            self._pending.pop(session_id, None)
+        if session_id in self._again:
+            self._again.discard(session_id)
+            self._schedule(session_id)
+
+    async def join(self):
+        """等待所有刷新完成"""
+        while self._pending:
+            await asyncio.gather(*list(self._pending.values()), return_exceptions=True)
+
+    async def _run(self, session_id):
+        try:
+            rendered = await self._render(session_id)
+            if rendered is None:
+                return
+            text, reply_markup = rendered
+
+            digest = self.digest(text, reply_markup)
+            if self._hashes.get(session_id) == digest:
+                self.stats['skipped'] += 1
+                return
+
+            changed = await self._edit(session_id, text, reply_markup)
+            if changed is None:
+                self.stats['dropped'] += 1
+                return
+            self._hashes.set(session_id, digest)
+            self._last_edit.set(session_id, time.monotonic())
+            self.stats['sent' if changed is not False else 'skipped'] += 1
+        except Exception as e:
+            logging.error(f"刷新信息卡片失败: {str(e)}")
@@ -0,0 +1,84 @@
+"""导入耗时回归检查
+
+在临时目录中使用 config.yml.example（填入占位凭据）以 `python -X importtime` 导入 handler
+（handler 会同时导入 bot），检查累计导入耗时不超过预算，且按需加载的重型依赖没有在导入时被加载。
+
+用法：python check_importtime.py [--budget-ms 2500]
+"""
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import yaml
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# 这些模块只应在首次使用时加载
+LAZY_MODULES = ('PIL', 'openai', 'pydub', 'boto3', 'location_names')
+
+_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)$')
+
+
+def measure(module, workdir):
+    """返回 ({模块名: 累计导入耗时毫秒}, 导入时加载的全部模块名)"""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=workdir, env=env, capture_output=True, text=True, timeout=120
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败:\n{result.stderr[-2000:]}")
+
+    cumulative, loaded = {}, set()
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            cumulative[match.group(3)] = int(match.group(2)) / 1000
+            loaded.add(match.group(3))
+    return cumulative, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=2500, help='bot/handler 的累计导入耗时上限（毫秒）')
+    args = parser.parse_args()
+
+    with open(os.path.join(ROOT, 'config.yml.example'), 'r', encoding='utf-8') as f:
+        config = yaml.safe_load(f)
+    config['bot'].update({'token': '0:placeholder', 'groupId': -100})
+    config['crisp'].update({'id': 'placeholder', 'key': 'placeholder', 'website': 'placeholder'})
+
+    workdir = tempfile.mkdtemp(prefix='importtime-')
+    failures = []
+    try:
+        with open(os.path.join(workdir, 'config.yml'), 'w', encoding='utf-8') as f:
+            yaml.dump(config, f, allow_unicode=True)
+
+        # bot 与 handler 相互导入，只能从 handler 开始导入
+        cumulative, loaded = measure('handler', workdir)
+        for module in ('bot', 'handler'):
+            elapsed = cumulative.get(module)
+            if elapsed is None:
+                failures.append(f"没有找到 {module} 的导入耗时")
+                continue
+            print(f"{module}: {elapsed:.1f} ms（预算 {args.budget_ms:.0f} ms）")
+            if elapsed > args.budget_ms:
+                failures.append(f"{module} 导入耗时超出预算")
+
+        eager = sorted(name for name in loaded if name.split('.')[0] in LAZY_MODULES)
+        if eager:
+            failures.append(f"导入时加载了应按需加载的模块: {', '.join(eager)}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for failure in failures:
+        print(f"失败: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
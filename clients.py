@@ -0,0 +1,34 @@
+from crisp_async import AsyncCrisp
+from http_client import HttpClient
+
+# 以 python bot.py 启动时 bot.py 作为 __main__ 运行，handler 中的 import bot 会再加载一份 bot 模块，
+# 共用的客户端放在这里，保证整个进程只有一个连接池和一组 Crisp 并发限制
+http = None
+crisp = None
+
+
+def init(config):
+    """创建（或返回已创建的）共用 HttpClient 和 AsyncCrisp"""
+    global http, crisp
+    if http is None:
+        # 所有出站 HTTP 请求（Crisp、图床、音频下载）共用的连接池
+        httpCfg = config.get('http', {})
+        http = HttpClient(
+            limit=httpCfg.get('limit', 100),
+            limit_per_host=httpCfg.get('limit_per_host', 10),
+            timeout=httpCfg.get('timeout', 10),
+            retries=httpCfg.get('retries', 3),
+            backoff=httpCfg.get('backoff', 0.5),
+            max_backoff=httpCfg.get('max_backoff', 10)
+        )
+
+        # 异步 Crisp 客户端，事件循环中的处理器都通过它调用 Crisp 接口
+        crispCfg = config['crisp']
+        crisp = AsyncCrisp(
+            http,
+            crispCfg['id'],
+            crispCfg['key'],
+            timeout=crispCfg.get('timeout', 10),
+            max_concurrency=crispCfg.get('max_concurrency', 10)
+        )
+    return http, crisp
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import random
+import time
+
+import aiohttp
+from crisp_api.errors.route import RouteError
+
+from metrics import REGISTRY
+from tracing import span
+
+CRISP_SECONDS = REGISTRY.histogram('crispbot_crisp_api_seconds', 'Crisp REST 接口调用耗时（秒）', ('endpoint', 'status'))
+
+
+class AsyncCrisp:
+    """异步 Crisp REST 客户端
+
+    与 crisp_api 的同步客户端返回值保持一致（返回响应中的 data 字段，出错时抛出 RouteError），
+    请求通过共用的 HttpClient 连接池发送，并限制并发数，避免阻塞事件循环。
+    发送消息时附带客户端生成的 fingerprint，重试时保持不变，因此消息发送也可以安全重试。
+    """
+
+    REST_URL = "https://api.crisp.chat/v1"
+
+    def __init__(self, http, identifier, key, tier="plugin", timeout=10, max_concurrency=10):
+        self._http = http
+        self._auth = aiohttp.BasicAuth(identifier, key)
+        self._headers = {
+            "Content-Type": "application/json",
+            "X-Crisp-Tier": tier
+        }
+        self._timeout = timeout
+        self._max_concurrency = max_concurrency
+        self._semaphore = None
+
+    async def _request(self, endpoint, method, resource, query=None, data=None, idempotent=None):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        async with self._semaphore:
+            started = time.monotonic()
+            status = 'error'
+            try:
+                with span(f"crisp.{endpoint}"):
+                    response = await self._http.request(
+                        method,
+                        self.REST_URL + resource,
+                        params=query,
+                        data=(json.dumps(data) if data is not None else None),
+                        headers=self._headers,
+                        auth=self._auth,
+                        timeout=self._timeout,
+                        idempotent=idempotent
+                    )
+                status = response.status
+            finally:
+                CRISP_SECONDS.observe(time.monotonic() - started, endpoint=endpoint, status=status)
+
+        try:
+            result = response.json()
+        except ValueError:
+            result = {}
+
+        if response.status >= 400:
+            reason_message = result.get("reason", "http_error")
+            raise RouteError({
+                "reason": "error",
+                "message": reason_message,
+                "code": response.status,
+                "data": {
+                    "namespace": "response",
+                    "message": f"Got response error: {reason_message}"
+                }
+            })
+
+        return result.get("data", {})
+
+    @staticmethod
+    def _conversation(website_id, session_id, path=""):
+        return f"/website/{website_id}/conversation/{session_id}{path}"
+
+    async def get_conversation(self, website_id, session_id):
+        return await self._request("get_conversation", "GET", self._conversation(website_id, session_id))
+
+    async def get_conversation_metas(self, website_id, session_id):
+        return await self._request("get_conversation_metas", "GET", self._conversation(website_id, session_id, "/meta"))
+
+    async def list_conversations(self, website_id, page_number=1, query=None):
+        return await self._request("list_conversations", "GET", f"/website/{website_id}/conversations/{page_number}", query=query)
+
+    async def get_messages_in_conversation(self, website_id, session_id, query=None):
+        return await self._request("get_messages_in_conversation", "GET", self._conversation(website_id, session_id, "/messages"), query=query)
+
+    async def send_message_in_conversation(self, website_id, session_id, data):
+        # fingerprint 在重试之间保持不变，Crisp 据此识别同一条消息
+        data = dict(data)
+        data.setdefault("fingerprint", random.getrandbits(52))
+        return await self._request(
+            "send_message_in_conversation",
+            "POST",
+            self._conversation(website_id, session_id, "/message"),
+            data=data,
+            idempotent=True
+        )
+
+    async def mark_messages_read_in_conversation(self, website_id, session_id, data):
+        # 标记已读和修改状态重复执行结果相同，可以安全重试
+        return await self._request("mark_messages_read_in_conversation", "PATCH", self._conversation(website_id, session_id, "/read"), data=data, idempotent=True)
+
+    async def change_conversation_state(self, website_id, session_id, data):
+        return await self._request("change_conversation_state", "PATCH", self._conversation(website_id, session_id, "/state"), data=data, idempotent=True)
+
+    async def get_connect_account(self):
+        return await self._request("get_connect_account", "GET", "/plugin/connect/account")
+
+    async def get_website(self, website_id):
+        return await self._request("get_website", "GET", f"/website/{website_id}")
+
+    async def get_connect_endpoints(self):
+        return await self._request("get_connect_endpoints", "GET", "/plugin/connect/endpoints")
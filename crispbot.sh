@@ -355,7 +355,7 @@ update() {
         
         # 拉取特定文件
         git fetch origin main
-        if git checkout origin/main -- bot.py handler.py location_names.py requirements.txt config.yml.example; then
+        if git checkout origin/main -- bot.py handler.py location_names.py sessions.py crisp_async.py cache.py card_refresh.py session_store.py keyword_matcher.py ai_memory.py ai_cache.py image_upload.py audio_transcode.py dispatcher.py outbound.py http_client.py startup.py backfill.py rtm_supervisor.py metrics.py tracing.py clients.py requirements.txt config.yml.example; then
             echo -e "${GREEN}成功拉取更新${NC}"
             break
         else
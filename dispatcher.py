@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import time
+
+from metrics import REGISTRY
+
+EVENT_WAIT = REGISTRY.histogram('crispbot_event_wait_seconds', 'RTM 事件在会话队列中的等待时间（秒）')
+EVENT_SECONDS = REGISTRY.histogram('crispbot_event_seconds', 'RTM 事件从收到到处理完成的总耗时（秒）')
+
+
+class SessionDispatcher:
+    """按会话排队的事件分发器
+
+    每个会话有独立的先进先出队列和工作协程，同一会话内的事件严格按顺序处理，
+    不同会话之间并行处理，同时处理的事件数受 max_concurrency 限制；
+    空闲超过 idle_timeout 秒的工作协程会自动退出。
+
+    Args:
+        handler: async (event) -> None，处理单个事件
+        max_concurrency: 全局同时处理的事件数上限
+        idle_timeout: 会话工作协程的空闲回收时间（秒）
+    """
+
+    def __init__(self, handler, max_concurrency=20, idle_timeout=60):
+        self._handler = handler
+        self._max_concurrency = max_concurrency
+        self._semaphore = None
+        self.idle_timeout = idle_timeout
+        self._queues = {}
+        self._workers = {}
+        self._waits = {}
+
+    def submit(self, session_id, event):
+        """将事件加入会话队列，立即返回"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        queue = self._queues.get(session_id)
+        if queue is None:
+            queue = self._queues[session_id] = asyncio.Queue()
+        queue.put_nowait((time.monotonic(), event))
+        if session_id not in self._workers:
+            self._workers[session_id] = asyncio.create_task(self._work(session_id, queue))
+
+    async def _work(self, session_id, queue):
+        while True:
+            try:
+                enqueued_at, event = await asyncio.wait_for(queue.get(), timeout=self.idle_timeout)
+            except asyncio.TimeoutError:
+                # 空闲回收，检查和移除之间不会有新事件插入（单线程事件循环）
+                if queue.empty():
+                    self._workers.pop(session_id, None)
+                    self._queues.pop(session_id, None)
+                    self._waits.pop(session_id, None)
+                    return
+                continue
+
+            async with self._semaphore:
+                self._waits[session_id] = time.monotonic() - enqueued_at
+                EVENT_WAIT.observe(self._waits[session_id])
+                try:
+                    await self._handler(event)
+                except Exception as e:
+                    logging.error(f"处理会话 {session_id} 的事件失败: {str(e)}")
+                EVENT_SECONDS.observe(time.monotonic() - enqueued_at)
+
+    def stats(self):
+        """各会话的队列深度和最近一次事件的排队等待时间（秒）"""
+        return {
+            session_id: {
+                'depth': queue.qsize(),
+                'wait': self._waits.get(session_id, 0.0)
+            }
+            for session_id, queue in self._queues.items()
+        }
+
+    @property
+    def active_workers(self):
+        return len(self._workers)
@@ -1,33 +1,39 @@
 import bot
-import json
-import base64
 import socketio
-import requests
 import logging
 import io
-from location_names import translation_dict  # 导入词典文件
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 from telegram.ext import ContextTypes
-from telegram.ext import MessageHandler, filters
-from PIL import Image
-from contextlib import contextmanager
 import yaml
 import subprocess
 import os
 import asyncio
-import sys
 import telegram  # 添加这行在文件开头
 import time
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-import tempfile
-from pydub import AudioSegment
+import html
+import hashlib
+from sessions import SessionRegistry
+from cache import TTLCache
+from card_refresh import CardRefresher
+from session_store import open_store, migrate_yaml
+from keyword_matcher import KeywordMatcher
+from ai_memory import ConversationMemory
+from ai_cache import AnswerCache
+from image_upload import ImageUploader, UploadCache
+from audio_transcode import AudioTranscoder
+from dispatcher import SessionDispatcher
+from backfill import GapBackfill
+from rtm_supervisor import RTMSupervisor, EndpointCache
+from startup import timeline
+from metrics import REGISTRY
+from tracing import Tracer, Profiler, stage, current as current_trace
+from outbound import OutboundScheduler, PRIORITY_VISITOR, PRIORITY_PREVIEW, PRIORITY_CARD
 
 
 
 config = bot.config
-client = bot.client
+crisp = bot.crisp
 openai = bot.openai
 changeButton = bot.changeButton
 groupId = config["bot"]["groupId"]
@@ -43,27 +49,86 @@ nicknames = config.get('nicknames', {
     'system_message': '系统消息'
 })
 
-# 修改重试策略配置
-retry_strategy = Retry(
-    total=5,  # 增加重试次数
-    backoff_factor=2,  # 增加退避时间
-    status_forcelist=[429, 500, 502, 503, 504],
-    allowed_methods=["HEAD", "GET", "PUT", "DELETE", "OPTIONS", "TRACE", "POST", "PATCH"],  # 允许所有方法重试
-)
-adapter = HTTPAdapter(max_retries=retry_strategy)
-http = requests.Session()
-http.mount("https://", adapter)
-http.mount("http://", adapter)
+# 共用的 HTTP 连接池，只有幂等请求会重试
+http = bot.http
 
-# 修改 socket.io 客户端配置
+# socket.io 客户端自身不重连，连接由 rtm_supervisor 统一管理
 sio = socketio.AsyncClient(
-    reconnection_attempts=10,  # 增加重连次数
-    reconnection_delay=1,  # 初始重连延迟
-    reconnection_delay_max=60,  # 最大重连延迟
+    reconnection=False,
     logger=True,
     request_timeout=30  # 增加请求超时时间
 )
 
+# 会话持久化存储，首次启动时从旧的 session_mapping.yml 迁移
+session_store = open_store(config.get('session_store', {}))
+migrate_yaml(session_store)
+
+# 会话注册表，只在内存中保留最近活跃的会话，其余的按需从存储读取
+session_registry = SessionRegistry(
+    session_store,
+    max_resident=config.get('session_store', {}).get('max_resident', 1000)
+)
+
+# AI 对话上下文，按会话保存最近的对话轮次
+memory_config = config["openai"].get("memory", {})
+ai_memory = ConversationMemory(
+    store=session_store,
+    max_turns=memory_config.get("max_turns", 20),
+    token_budget=memory_config.get("token_budget", 2000),
+    max_sessions=memory_config.get("max_sessions", 1000),
+    flush_delay=memory_config.get("flush_delay", 5)
+)
+
+# AI 回复缓存，相同问题直接复用之前的回复
+answer_cache_config = config["openai"].get("answer_cache", {})
+answer_cache = AnswerCache(
+    payload,
+    ttl=answer_cache_config.get("ttl", 86400),
+    max_size=answer_cache_config.get("max_size", 1000),
+    path=answer_cache_config.get("path", "data/ai_cache.json") or None,
+    save_delay=answer_cache_config.get("save_delay", 5)
+) if answer_cache_config.get("enabled", True) else None
+
+# 访客元信息缓存，收到 session:set_data 事件时更新
+meta_cache_config = config.get('meta_cache', {})
+meta_cache = TTLCache(
+    maxsize=meta_cache_config.get('max_size', 1000),
+    ttl=meta_cache_config.get('ttl', 600)
+)
+
+# 图床上传
+image_uploader = ImageUploader(config.get('image_upload', {}), http)
+
+# 已上传图片缓存，有效期略短于图床上的保存时间
+upload_cache_config = config.get('image_upload', {}).get('cache', {})
+imgbb_expiration = config.get('image_upload', {}).get('imgbb_expiration', 0)
+upload_cache = UploadCache(
+    path=upload_cache_config.get('path', 'data/upload_cache.json') or None,
+    max_size=upload_cache_config.get('max_size', 2000),
+    ttl=int(imgbb_expiration * 0.9) if imgbb_expiration else None,
+    save_delay=upload_cache_config.get('save_delay', 5)
+) if upload_cache_config.get('enabled', True) else None
+
+# Telegram 出站请求调度：按优先级排队，并按聊天和全局限速
+outbound_config = config.get('outbound', {})
+outbound = OutboundScheduler(
+    chat_rate=outbound_config.get('chat_rate', 20),
+    chat_period=outbound_config.get('chat_period', 60),
+    chat_burst=outbound_config.get('chat_burst', 10),
+    global_rate=outbound_config.get('global_rate', 30),
+    max_retries=outbound_config.get('max_retries', 3)
+)
+preview_stale_after = outbound_config.get('preview_stale_after', 10)
+card_stale_after = outbound_config.get('card_stale_after', 60)
+
+# 访客语音转码
+audio_config = config.get('audio', {})
+audio_transcoder = AudioTranscoder(
+    http,
+    max_concurrency=audio_config.get('max_concurrency', 2),
+    timeout=audio_config.get('timeout', 60)
+)
+
 def print_enabled_image_services():
     enabled_services = config.get('image_upload', {}).get('enabled_services', {})
     
@@ -79,123 +144,46 @@ def print_enabled_image_services():
     if not any(enabled_services.values()):
         logging.warning("警告：当前没有启用任何图床服务")
 
-@contextmanager
-def api_upload_context(api_type):
-    logging.info(f"开始尝试上传到 {api_type}")
-    try:
-        yield
-    except Exception as e:
-        logging.error(f"上传到 {api_type} 失败: {str(e)}")
-    finally:
-        logging.info(f"结束 {api_type} 上传尝试")
-
 # 新增函数：上传图片到图床
-def upload_image_to_telegraph(image_data):
-    enabled_services = config.get('image_upload', {}).get('enabled_services', {})
-    apis = [
-        {
-            "url": "https://api.imgbb.com/1/upload",
-            "type": "imgbb", 
-            "enabled": enabled_services.get('imgbb', True),
-            "process_response": lambda r: r.json()['data']['url']
-        },
-        {
-            "url": "https://file.sang.pub/api/upload",
-            "type": "sang_pub",
-            "enabled": enabled_services.get('sang_pub', False),
-            "process_response": lambda r: r.text.strip()
-        },
-        {
-            "url": f"https://api.cloudinary.com/v1_1/{config.get('image_upload', {}).get('cloudinary', {}).get('cloud_name', '')}/image/upload",
-            "type": "cloudinary",
-            "enabled": enabled_services.get('cloudinary', False),
-            "process_response": lambda r: r.json()['secure_url']
-        },
-        {
-            "url": "https://telegra.ph/upload",
-            "type": "telegraph",
-            "enabled": enabled_services.get('telegraph', False),  # 默认设置为禁用
-            "process_response": lambda r: 'https://telegra.ph' + r.json()[0]['src']
-        }
-    ]
-
+@stage('upload_image')
+async def upload_image_to_telegraph(image_data):
     # 验证图片数据
-    if not isinstance(image_data, (bytes, io.BytesIO)):
+    if not isinstance(image_data, (bytes, bytearray, io.BytesIO)):
         raise ValueError("image_data 必须是 bytes 或 BytesIO 对象")
     
-    image_bytes = image_data.getvalue() if isinstance(image_data, io.BytesIO) else image_data
-
-    # 检测图片格式
-    try:
-        with Image.open(io.BytesIO(image_bytes)) as img:
-            img_format = img.format.lower()
-    except Exception as e:
-        logging.error(f"无法检测图片格式: {str(e)}")
-        img_format = 'jpeg'
+    image_bytes = image_data.getvalue() if isinstance(image_data, io.BytesIO) else bytes(image_data)
+    return await image_uploader.upload(image_bytes)
 
-    for api in apis:
-        if not api["enabled"]:
-            logging.info(f"跳过已禁用的图床服务: {api['type']}")
-            continue
-            
-        with api_upload_context(api["type"]):
-            try:
-                if api["type"] == "imgbb":
-                    imgbb_api_key = config.get('image_upload', {}).get('imgbb_api_key')
-                    if not imgbb_api_key:
-                        logging.warning("ImgBB API密钥未设置")
-                        continue
-                        
-                    files = {'image': (f'image.{img_format}', image_bytes, f'image/{img_format}')}
-                    params = {
-                        'key': imgbb_api_key,
-                        'expiration': config.get('image_upload', {}).get('imgbb_expiration', 0)
-                    }
-                    response = requests.post(api["url"], files=files, params=params, timeout=10)
-                
-                elif api["type"] == "cloudinary":
-                    cloudinary_config = config.get('image_upload', {}).get('cloudinary', {})
-                    if not all([cloudinary_config.get('cloud_name'), cloudinary_config.get('upload_preset')]):
-                        logging.warning("Cloudinary配置不完整")
-                        continue
-                        
-                    data = {
-                        "file": f"data:image/{img_format};base64,{base64.b64encode(image_bytes).decode('utf-8')}",
-                        "upload_preset": cloudinary_config['upload_preset']
-                    }
-                    response = requests.post(api["url"], json=data, timeout=10)
-                
-                else:
-                    files = {'file': (f'image.{img_format}', image_bytes, f'image/{img_format}')}
-                    response = requests.post(api["url"], files=files, timeout=10)
+async def upload_telegram_photo(photo):
+    """上传 Telegram 图片，同一张图片（file_unique_id 或内容相同）只下载、上传一次"""
+    if upload_cache is not None:
+        if image_url := upload_cache.get_by_file_id(photo.file_unique_id):
+            return image_url
 
-                response.raise_for_status()
-                image_url = api["process_response"](response)
-                
-                if not image_url or not image_url.startswith('http'):
-                    raise ValueError(f"无效的图片URL: {image_url}")
-                    
-                logging.info(f"成功上传到 {api['type']}: {image_url}")
-                return image_url
+    photo_file = await photo.get_file()
+    image_bytes = bytes(await photo_file.download_as_bytearray())
+    if upload_cache is None:
+        return await upload_image_to_telegraph(image_bytes)
 
-            except requests.exceptions.RequestException as e:
-                logging.error(f"上传到 {api['type']} 失败: {str(e)}")
-                if hasattr(e, 'response') and e.response:
-                    logging.error(f"错误详情: {e.response.text}")
-            except Exception as e:
-                logging.error(f"上传到 {api['type']} 时发生未知错误: {str(e)}")
-                
-    raise Exception("所有启用的图片上传API都失败了")
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    image_url = upload_cache.get_by_digest(digest)
+    if image_url is None:
+        image_url = await upload_image_to_telegraph(image_bytes)
+    upload_cache.put(image_url, file_unique_id=photo.file_unique_id, digest=digest)
+    return image_url
 
 
+@stage('getKey')
 def getKey(content: str):
-    if len(config["autoreply"]) > 0:
-        for x in config["autoreply"]:
-            keyword = x.split("|")
-            for key in keyword:
-                if key in content:
-                    return True, config["autoreply"][x]
-    return False, None
+    return keyword_matcher.match(content)
+
+def rebuild_keyword_matcher():
+    """关键字表变化后重建匹配自动机，构建完成后再整体替换引用"""
+    global keyword_matcher
+    keyword_matcher = KeywordMatcher(config.get("autoreply") or {})
+
+# 自动回复关键字匹配自动机
+keyword_matcher = KeywordMatcher(config.get("autoreply") or {})
 
 def escape_markdown(text, preserve_backticks=False):
     """转义 Markdown 特殊字符
@@ -225,17 +213,52 @@ def escape_markdown(text, preserve_backticks=False):
         
     return text
 
-def getMetas(sessionId):
-    conversation = client.website.get_conversation(websiteId, sessionId)
-    
+def translateLocation(name):
+    # 地名词典只在首次渲染访客位置时加载
+    from location_names import translation_dict
+    return translation_dict.get(name, name)
+
+async def fetchMetas(sessionId):
+    """获取会话信息和元数据，优先使用缓存
+
+    Returns:
+        (conversation, metas)，获取会话信息失败时 conversation 为 None
+    """
+    cached = meta_cache.get(sessionId)
+    if cached is not None:
+        return cached
+
+    # 并发获取会话信息和元数据
+    conversation, metas = await asyncio.gather(
+        crisp.get_conversation(websiteId, sessionId),
+        crisp.get_conversation_metas(websiteId, sessionId),
+        return_exceptions=True
+    )
+
+    if isinstance(conversation, Exception):
+        logging.error(f"获取会话信息失败: {str(conversation)}")
+        return None, {}
+
+    if isinstance(metas, Exception):
+        logging.error(f"获取会话元数据失败: {str(metas)}")
+        return conversation, {}
+
+    meta_cache.set(sessionId, (conversation, metas))
+    return conversation, metas
+
+@stage('getMetas')
+async def getMetas(sessionId):
+    conversation, metas = await fetchMetas(sessionId)
+    return renderMetas(conversation, metas)
+
+def renderMetas(conversation, metas):
     # 使用列表推导式构建信息流
     flow = ['*Crisp消息推送*']
     
-    if conversation.get("error"):
+    if conversation is None:
         return '\n'.join(flow + ['无法获取会话信息'])
 
     data = conversation.get("data", {})
-    metas = client.website.get_conversation_metas(websiteId, sessionId)
     
     # 修改信息映射结构，为邮箱和账号特殊处理
     info_mapping = [
@@ -289,9 +312,9 @@ def getMetas(sessionId):
     if device := metas.get("device"):
         if geolocation := device.get("geolocation"):
             geo_mapping = [
-                ('country', '🇺🇸*国家*', lambda x: translation_dict.get(x, x)),
-                ('region', '🏙️*地区*', lambda x: translation_dict.get(x, x)),
-                ('city', '🌆*城市*', lambda x: translation_dict.get(x, x)),
+                ('country', '🇺🇸*国家*', translateLocation),
+                ('region', '🏙️*地区*', translateLocation),
+                ('city', '🌆*城市*', translateLocation),
             ]
             
             for key, prefix, translator in geo_mapping:
@@ -322,138 +345,117 @@ def getMetas(sessionId):
     return '\n'.join(flow) if len(flow) > 1 else '\n'.join(flow + ['无额外信息'])
 
 
-# 添加新的函数来处理会话映射的持久化
-def save_session_mapping(session_id, topic_id, message_id=None, enable_ai=False):
-    try:
-        mapping_file = 'session_mapping.yml'
-        # 读取现有映射
-        try:
-            with open(mapping_file, 'r', encoding='utf-8') as f:
-                mapping = yaml.safe_load(f) or {}
-        except FileNotFoundError:
-            mapping = {}
-        
-        # 更新映射，只保存必要信息
-        mapping[session_id] = {
-            'topic_id': topic_id,
-            'message_id': message_id,
-            'enable_ai': enable_ai
-        }
-        
-        # 保存映射
-        with open(mapping_file, 'w', encoding='utf-8') as f:
-            yaml.dump(mapping, f, allow_unicode=True)
-            
-    except Exception as e:
-        logging.error(f"保存会话映射失败: {str(e)}")
-
-def load_session_mapping():
-    try:
-        mapping_file = 'session_mapping.yml'
-        try:
-            with open(mapping_file, 'r', encoding='utf-8') as f:
-                mapping = yaml.safe_load(f) or {}
-                # 验证和清理数据，只保留必要字段
-                cleaned_mapping = {}
-                for session_id, data in mapping.items():
-                    if isinstance(data, dict) and 'topic_id' in data:
-                        cleaned_mapping[session_id] = {
-                            'topic_id': data['topic_id'],
-                            'message_id': data.get('message_id'),
-                            'enable_ai': data.get('enable_ai', False)
-                        }
-                return cleaned_mapping
-        except FileNotFoundError:
-            return {}
-    except Exception as e:
-        logging.error(f"加载会话映射失败: {str(e)}")
-        return {}
-
+@stage('createSession')
 async def createSession(data):
     try:
         bot = callbackContext.bot
-        botData = callbackContext.bot_data
         session_id = data["session_id"]
         nickname = data["user"]["nickname"]
-        session = botData.get(session_id)
-
-        metas = getMetas(session_id)
-        print(f"获取到的元信息: {metas}")
+        session = session_registry.get(session_id)
 
         if session is None:
+            metas = await getMetas(session_id)
+            print(f"获取到的元信息: {metas}")
+
             enableAI = False if openai is None else True
             # 创建新话题
-            topic = await bot.create_forum_topic(
+            topic = await outbound.call(
+                groupId,
+                bot.create_forum_topic,
                 chat_id=groupId,
                 name=nickname,
                 icon_color=0x6FB9F0
             )
             
             # 发送元信息消息
-            msg = await bot.send_message(
+            reply_markup = changeButton(session_id, enableAI)
+            msg = await outbound.call(
+                groupId,
+                bot.send_message,
                 groupId,
                 metas,
                 message_thread_id=topic.message_thread_id,
-                reply_markup=changeButton(session_id, enableAI),
+                reply_markup=reply_markup,
                 parse_mode='MarkdownV2'
             )
+            card_refresher.remember(session_id, metas, reply_markup)
             
-            # 保存映射到文件和内存，只保存必要信息
-            save_session_mapping(
-                session_id=session_id,
-                topic_id=topic.message_thread_id,
+            # 保存映射到存储和注册表，新会话的 first_message 为 True
+            session_registry.create(
+                session_id,
+                topic.message_thread_id,
                 message_id=msg.message_id,
                 enable_ai=enableAI
             )
-            
-            botData[session_id] = {
-                'topicId': topic.message_thread_id,
-                'messageId': msg.message_id,
-                'enableAI': enableAI,
-                'first_message': True  # 新会话设置为 True
-            }
 
         else:
+            # 已有会话只请求刷新信息卡片，内容未变或短时间内重复刷新时不会真正编辑；
+            # 刷新在后台进行，访客消息不必等待优先级最低的卡片编辑
+            card_refresher.refresh(session_id)
+
+    except Exception as error:
+        logging.error(f"创建会话失败: {str(error)}")
+
+async def renderCard(session_id):
+    session = session_registry.get(session_id)
+    if session is None:
+        return None
+    metas = await getMetas(session_id)
+    return metas, changeButton(session_id, session.enable_ai)
+
+async def editCard(session_id, metas, reply_markup):
+    bot = callbackContext.bot
+    session = session_registry.get(session_id)
+    try:
+        # 尝试更新现有消息，排队过久或有更新的卡片内容时本次编辑会被丢弃
+        result = await outbound.call(
+            groupId,
+            bot.edit_message_text,
+            metas,
+            chat_id=groupId,
+            message_id=session.message_id,
+            reply_markup=reply_markup,
+            parse_mode='MarkdownV2',
+            priority=PRIORITY_CARD,
+            stale_after=card_stale_after,
+            key=('card', session_id)
+        )
+        if result is None:
+            return None
+    except telegram.error.BadRequest as e:
+        if "Message to edit not found" in str(e):
+            logging.warning(f"找不到要编辑的消息(ID: {session.message_id})，尝试重新发送")
             try:
-                # 尝试更新现有消息
-                await bot.edit_message_text(
+                # 重新发送元信息消息
+                msg = await outbound.call(
+                    groupId,
+                    bot.send_message,
+                    groupId,
                     metas,
-                    chat_id=groupId,
-                    message_id=session['messageId'],
-                    reply_markup=changeButton(session_id, session.get("enableAI", False)),
+                    message_thread_id=session.topic_id,
+                    reply_markup=reply_markup,
                     parse_mode='MarkdownV2'
                 )
-            except telegram.error.BadRequest as e:
-                if "Message to edit not found" in str(e):
-                    logging.warning(f"找不到要编辑的消息(ID: {session['messageId']})，尝试重新发送")
-                    try:
-                        # 重新发送元信息消息
-                        msg = await bot.send_message(
-                            groupId,
-                            metas,
-                            message_thread_id=session['topicId'],
-                            reply_markup=changeButton(session_id, session.get("enableAI", False)),
-                            parse_mode='MarkdownV2'
-                        )
-                        # 更新消息ID
-                        session['messageId'] = msg.message_id
-                        # 更新映射
-                        save_session_mapping(
-                            session_id=session_id,
-                            topic_id=session['topicId'],
-                            message_id=msg.message_id,
-                            enable_ai=session.get("enableAI", False)
-                        )
-                        logging.info(f"已重新发送元信息消息，新消息ID: {msg.message_id}")
-                    except Exception as send_error:
-                        logging.error(f"重新发送元信息失败: {str(send_error)}")
-                elif "Message is not modified" not in str(e):
-                    logging.error(f"更新元信息失败: {str(e)}")
-            except Exception as error:
-                logging.error(f"更新元信息失败: {str(error)}")
-
+                # 更新消息ID
+                session_registry.update(session, message_id=msg.message_id)
+                logging.info(f"已重新发送元信息消息，新消息ID: {msg.message_id}")
+            except Exception as send_error:
+                logging.error(f"重新发送元信息失败: {str(send_error)}")
+        elif "Message is not modified" in str(e):
+            return False
+        else:
+            logging.error(f"更新元信息失败: {str(e)}")
     except Exception as error:
-        logging.error(f"创建会话失败: {str(error)}")
+        logging.error(f"更新元信息失败: {str(error)}")
+    return True
+
+# 信息卡片刷新器，同一会话在窗口期内的多次刷新只会编辑一次
+card_refresher = CardRefresher(
+    renderCard,
+    editCard,
+    window=config.get('info_card', {}).get('refresh_window', 10),
+    max_sessions=config.get('info_card', {}).get('max_sessions', 1000)
+)
 
 # 新增函数：处理 Telegram 发来的图片
 async def handle_telegram_photo(update, context):
@@ -461,20 +463,14 @@ async def handle_telegram_photo(update, context):
     try:
         msg = update.message
         
-        # 从 bot_data 中查找 session_id
-        session_id = None
-        for sid, sdata in context.bot_data.items():
-            if sdata.get('topicId') == msg.message_thread_id:
-                session_id = sid
-                break
+        # 通过话题查找会话，不在内存中时从存储读取
+        session = session_registry.by_topic(msg.message_thread_id)
+        session_id = session.session_id if session is not None else None
         
         if session_id:
             # 上传图片
-            photo_file = await msg.photo[-1].get_file()
-            image_bytes = await photo_file.download_as_bytearray()
-
             print("开始上传图片")
-            image_url = upload_image_to_telegraph(io.BytesIO(image_bytes))
+            image_url = await upload_telegram_photo(msg.photo[-1])
             print(f"图片上传成功，URL: {image_url}")
             
             markdown_image = f"[![image]({image_url})]({image_url}) \n点击图片可查看高清大图"
@@ -491,7 +487,7 @@ async def handle_telegram_photo(update, context):
             }
             
             # 直接发送消息
-            client.website.send_message_in_conversation(
+            await crisp.send_message_in_conversation(
                 config['crisp']['website'],
                 session_id,
                 query
@@ -505,16 +501,89 @@ async def handle_telegram_photo(update, context):
         await update.message.reply_text("发送图片失败，请稍后重试。")
 
 
+OPENAI_SECONDS = REGISTRY.histogram('crispbot_openai_seconds', 'OpenAI 调用耗时（秒）', ('call', 'result'))
+OPENAI_FIRST_TOKEN = REGISTRY.histogram('crispbot_openai_first_token_seconds', 'OpenAI 流式回复首个分片的等待时间（秒）')
+
+async def streamAIReply(topicId, messages, flow):
+    """流式生成 AI 回复，生成过程中节流编辑话题中的同一条消息
+
+    Args:
+        messages: 发送给模型的完整消息列表（含系统提示和上下文）
+
+    Returns:
+        完整的回复内容，生成失败时返回 None
+    """
+    bot = callbackContext.bot
+    interval = config["openai"].get("stream_edit_interval", 1.5)
+    message = await outbound.call(
+        groupId,
+        bot.send_message,
+        groupId,
+        '\n'.join(flow + ["", "💡<b>自动回复</b>：⌛"]),
+        message_thread_id=topicId
+    )
+
+    async def preview(text, final=False):
+        suffix = "" if final else " ⌛"
+        try:
+            # 中间预览可以被更新的预览替换或过期丢弃，最终结果按访客消息优先级发送
+            await outbound.call(
+                groupId,
+                message.edit_text,
+                '\n'.join(flow + ["", f"💡<b>自动回复</b>：{html.escape(text)}{suffix}"]),
+                priority=PRIORITY_VISITOR if final else PRIORITY_PREVIEW,
+                stale_after=None if final else preview_stale_after,
+                key=('preview', message.message_id)
+            )
+        except telegram.error.BadRequest as e:
+            if "Message is not modified" not in str(e):
+                logging.error(f"更新 AI 回复预览失败: {str(e)}")
+
+    chunks = []
+    trace = current_trace()
+    started = time.monotonic()
+    try:
+        stream = await openai.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=messages,
+            stream=True
+        )
+        last_edit = time.monotonic()
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                if not chunks:
+                    OPENAI_FIRST_TOKEN.observe(time.monotonic() - started)
+                    if trace is not None:
+                        trace.add('openai.first_token', started, time.monotonic() - started)
+                chunks.append(chunk.choices[0].delta.content)
+                if time.monotonic() - last_edit >= interval:
+                    last_edit = time.monotonic()
+                    await preview(''.join(chunks))
+    except Exception as e:
+        OPENAI_SECONDS.observe(time.monotonic() - started, call='stream', result='error')
+        if trace is not None:
+            trace.add('openai.stream', started, time.monotonic() - started, type(e).__name__)
+        logging.error(f"AI 回复生成失败: {str(e)}")
+        await preview(''.join(chunks) + "\n（AI 回复生成失败）", final=True)
+        return None
+    OPENAI_SECONDS.observe(time.monotonic() - started, call='stream', result='ok')
+    if trace is not None:
+        trace.add('openai.stream', started, time.monotonic() - started)
+
+    autoreply = ''.join(chunks)
+    await preview(autoreply, final=True)
+    return autoreply
+
+@stage('sendMessage')
 async def sendMessage(data):
     try:
         bot = callbackContext.bot
-        botData = callbackContext.bot_data
         sessionId = data["session_id"]
-        session = botData.get(sessionId)
+        session = session_registry.get(sessionId)
 
         # 标记消息已读
         try:
-            client.website.mark_messages_read_in_conversation(
+            await crisp.mark_messages_read_in_conversation(
                 websiteId, 
                 sessionId,
                 {
@@ -532,11 +601,14 @@ async def sendMessage(data):
         if message_type == "text":
             # 检查消息内容是否为 111 或 222
             if content == '111' or content == '222':
-                session["enableAI"] = (content == '222')
-                await bot.edit_message_reply_markup(
+                session_registry.update(session, enable_ai=(content == '222'))
+                await outbound.call(
+                    groupId,
+                    bot.edit_message_reply_markup,
                     chat_id=groupId,
-                    message_id=session['messageId'],
-                    reply_markup=changeButton(sessionId, session["enableAI"])
+                    message_id=session.message_id,
+                    reply_markup=changeButton(sessionId, session.enable_ai),
+                    priority=PRIORITY_CARD
                 )
                 # 发送提示消息给对方
                 message_content = "AI客服已关闭" if content == '111' else "AI客服已开启"
@@ -550,7 +622,7 @@ async def sendMessage(data):
                         "avatar": avatars.get('system_message', 'https://example.com/system_avatar.png')
                     }
                 }
-                client.website.send_message_in_conversation(websiteId, sessionId, query)
+                await crisp.send_message_in_conversation(websiteId, sessionId, query)
                 return
 
             
@@ -558,8 +630,8 @@ async def sendMessage(data):
             flow.append(f"🧾<b>消息推送</b>： {content}")
 
             # 仅在会话的第一条消息时发送提示
-            if openai is not None and session.get("first_message", True):  # 检查是否是会话的第一条消息
-                session["first_message"] = False  # 标记为已发送提示
+            if openai is not None and session.first_message:  # 检查是否是会话的第一条消息
+                session.first_message = False  # 标记为已发送提示
                 hint_message = "您已接入智能客服 \n\n您可以输入 '111' 关闭AI客服，输入 '222' 开启AI客服。"
                 hint_query = {
                     "type": "text",
@@ -571,23 +643,31 @@ async def sendMessage(data):
                         "avatar": avatars.get('system_message', 'https://example.com/system_avatar.png')
                     }
                 }
-                client.website.send_message_in_conversation(websiteId, sessionId, hint_query)  # 发送提示消息
+                await crisp.send_message_in_conversation(websiteId, sessionId, hint_query)  # 发送提示消息
 
             result, autoreply = getKey(content)
+            previewed = False
             if result is True:
                 flow.append("")
                 flow.append(f"💡<b>自动回复</b>：{autoreply}")
-            elif openai is not None and session["enableAI"] is True:
-                response = openai.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": payload},
-                        {"role": "user", "content": content}
-                    ]
-                )
-                autoreply = response.choices[0].message.content
-                flow.append("")
-                flow.append(f"💡<b>自动回复</b>：{autoreply}")
+            elif openai is not None and session.enable_ai is True:
+                autoreply = answer_cache.get(content) if answer_cache is not None else None
+                if autoreply is not None:
+                    flow.append("")
+                    flow.append(f"💡<b>自动回复</b>（缓存）：{html.escape(autoreply)}")
+                else:
+                    # 流式生成回复，话题中的消息会随生成进度实时更新
+                    messages = ai_memory.messages(sessionId, payload, content)
+                    autoreply = await streamAIReply(session.topic_id, messages, flow)
+                    previewed = True
+                    # 只缓存不依赖上下文（仅有系统提示和当前问题）的回复
+                    if answer_cache is not None and autoreply and len(messages) == 2:
+                        answer_cache.put(content, autoreply)
+            
+            # 记录对话上下文
+            ai_memory.append(sessionId, "user", content)
+            if autoreply is not None:
+                ai_memory.append(sessionId, "assistant", autoreply)
             
             if autoreply is not None:
                 query = {
@@ -600,12 +680,15 @@ async def sendMessage(data):
                         "avatar": avatars.get('ai_agent', 'https://img.ixintu.com/download/jpg/20210125/8bff784c4e309db867d43785efde1daf_512_512.jpg')
                     }
                 }
-                client.website.send_message_in_conversation(websiteId, sessionId, query)
-            await bot.send_message(
-                groupId,
-                '\n'.join(flow),
-                message_thread_id=session["topicId"]
-            )
+                await crisp.send_message_in_conversation(websiteId, sessionId, query)
+            if not previewed:
+                await outbound.call(
+                    groupId,
+                    bot.send_message,
+                    groupId,
+                    '\n'.join(flow),
+                    message_thread_id=session.topic_id
+                )
         elif message_type == "file" and isinstance(content, dict):
             file_type = content.get("type", "")
             file_url = content.get("url", "")
@@ -614,12 +697,14 @@ async def sendMessage(data):
                 # 处理图片
                 flow = []
                 flow.append(f"📷 图片链接：{file_url}")
-                await bot.send_photo(
+                await outbound.call(
+                    groupId,
+                    bot.send_photo,
                     groupId,
                     file_url,
                     caption='\n'.join(flow),
                     parse_mode='HTML',
-                    message_thread_id=session["topicId"]
+                    message_thread_id=session.topic_id
                 )
                 
             elif "video" in file_type:
@@ -627,20 +712,24 @@ async def sendMessage(data):
                 flow = []
                 flow.append(f"🎬 用户发送了一段视频")
                 try:
-                    await bot.send_video(
+                    await outbound.call(
+                        groupId,
+                        bot.send_video,
                         groupId,
                         file_url,
                         caption='\n'.join(flow),
                         parse_mode='HTML',
-                        message_thread_id=session["topicId"]
+                        message_thread_id=session.topic_id
                     )
                 except Exception as e:
                     logging.error(f"发送视频失败: {str(e)}")
                     flow.append(f"🔗 视频链接: {file_url}")
-                    await bot.send_message(
+                    await outbound.call(
+                        groupId,
+                        bot.send_message,
                         groupId,
                         '\n'.join(flow),
-                        message_thread_id=session["topicId"]
+                        message_thread_id=session.topic_id
                     )
         elif message_type == "audio" and isinstance(content, dict):
             # 处理音频消息
@@ -651,53 +740,29 @@ async def sendMessage(data):
                 flow = []
                 flow.append(f"🎵 用户发送了一段语音")
                 try:
-                    # 下载音频文件
-                    response = requests.get(file_url, timeout=30)
-                    if response.status_code == 200:
-                        # 创建临时文件
-                        with tempfile.NamedTemporaryFile(suffix='.weba', delete=False) as temp_in:
-                            temp_in.write(response.content)
-                            temp_in_path = temp_in.name
-
-                        with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as temp_out:
-                            temp_out_path = temp_out.name
-
-                        try:
-                            # 转换音频格式
-                            audio = AudioSegment.from_file(temp_in_path)
-                            audio.export(temp_out_path, format='ogg')
-
-                            # 读取转换后的文件
-                            with open(temp_out_path, 'rb') as audio_file:
-                                await bot.send_voice(
-                                    groupId,
-                                    audio_file,
-                                    caption='\n'.join(flow),
-                                    duration=duration,
-                                    parse_mode='HTML',
-                                    message_thread_id=session["topicId"]
-                                )
-                            logging.info("语音发送成功")
-                        except Exception as convert_error:
-                            logging.error(f"音频转换失败: {str(convert_error)}")
-                            raise convert_error
-                        finally:
-                            # 清理临时文件
-                            try:
-                                os.unlink(temp_in_path)
-                                os.unlink(temp_out_path)
-                            except:
-                                pass
-                    else:
-                        raise Exception(f"下载音频失败，状态码: {response.status_code}")
+                    # 边下载边转码为 OGG/Opus，不使用临时文件
+                    voice = await audio_transcoder.transcode_url(file_url)
+                    await outbound.call(
+                        groupId,
+                        bot.send_voice,
+                        groupId,
+                        voice,
+                        caption='\n'.join(flow),
+                        duration=duration,
+                        parse_mode='HTML',
+                        message_thread_id=session.topic_id
+                    )
+                    logging.info("语音发送成功")
 
                 except Exception as e:
                     logging.error(f"发送语音失败: {str(e)}")
                     flow.append(f"🔗 语音链接: {file_url}")
-                    await bot.send_message(
+                    await outbound.call(
+                        groupId,
+                        bot.send_message,
                         groupId,
                         '\n'.join(flow),
-                        message_thread_id=session["topicId"]
+                        message_thread_id=session.topic_id
                     )
         else:
             logging.info(f"未处理的消息类型: {message_type}, 内容: {content}")
@@ -705,9 +770,35 @@ async def sendMessage(data):
     except Exception as error:
         logging.error(f"发送消息失败: {str(error)}")
 
+# 管理菜单只在首次连接时发送，重连时由 onRTMConnected 发送一条重连通知
+admin_menu_sent = False
+reconnect_notice_task = None
+
 # Def Event Handlers
 @sio.on("connect")
 async def connect():
+    global admin_menu_sent, backfill_task
+    try:
+        # 先完成认证再等待 Telegram 发送队列，避免认证被限速的消息拖延
+        await sio.emit("authentication", {
+            "tier": "plugin",
+            "username": config["crisp"]["id"],
+            "password": config["crisp"]["key"],
+            "events": [
+                "message:send",
+                "session:set_data"
+            ]})
+        # 断线重连后补发断线期间遗漏的消息（首次连接时不会执行），保存任务引用避免被回收
+        backfill_task = asyncio.create_task(backfill.run())
+    except Exception as e:
+        # 认证失败时断开连接，由 rtm_supervisor 退避后重新连接
+        logging.error(f"连接失败: {str(e)}")
+        await sio.disconnect()
+        return
+
+    if admin_menu_sent:
+        return
+    admin_menu_sent = True
     try:
         # 检查是否处于下班模式
         if "" in config.get('autoreply', {}):
@@ -740,114 +831,222 @@ async def connect():
                     InlineKeyboardButton("下班模式", callback_data="admin_off_duty")
                 ]
             ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await callbackContext.bot.send_message(
+        reply_markup = adminMenu(keyboard)
+
+        await outbound.call(
+            groupId,
+            callbackContext.bot.send_message,
             groupId,
             "已连接到 Crisp 服务器。",
             reply_markup=reply_markup
         )
-        await sio.emit("authentication", {
-            "tier": "plugin",
-            "username": config["crisp"]["id"],
-            "password": config["crisp"]["key"],
-            "events": [
-                "message:send",
-                "session:set_data"
-            ]})
     except Exception as e:
-        logging.error(f"连接失败: {str(e)}")
-        # 如果是网络错误，等待后重试
-        if isinstance(e, (ConnectionError, requests.exceptions.ConnectionError)):
-            await asyncio.sleep(5)
-            try:
-                await connect()
-            except Exception as retry_error:
-                logging.error(f"重试连接失败: {str(retry_error)}")
+        logging.error(f"发送管理菜单失败: {str(e)}")
 
 @sio.on("unauthorized")
 async def unauthorized(data):
     print('Unauthorized: ', data)
 @sio.event
-async def connect_error():
-    print("The connection failed!")
-    await callbackContext.bot.send_message(
+async def connect_error(data=None):
+    logging.error(f"无法连接到 Crisp 服务器: {data}")
+
+async def onRTMConnected(outage):
+    if outage is None:
+        timeline.mark("Crisp RTM 已连接")
+        logging.info(f"启动时间线：{timeline.summary()}")
+        return
+    # 重连通知优先级低于访客消息，在后台发送，不阻塞连接监管
+    global reconnect_notice_task
+    reconnect_notice_task = asyncio.create_task(outbound.call(
         groupId,
-        "无法连接到 Crisp 服务器。",
+        callbackContext.bot.send_message,
+        groupId,
+        f"已重新连接到 Crisp 服务器（中断 {outage:.0f} 秒）。",
+        priority=PRIORITY_CARD
+    ))
+
+async def onRTMDisconnected():
+    backfill.mark_disconnected()
+
+@sio.on("session:set_data")
+async def sessionSetData(data):
+    rtm_supervisor.touch()
+    if data.get("website_id") != websiteId:
+        return
+    session_id = data.get("session_id")
+    cached = meta_cache.get(session_id)
+    if cached is None:
+        return
+    # 直接用事件中的数据更新缓存，避免下次重新请求
+    conversation, metas = cached
+    if isinstance(data.get("data"), dict):
+        metas = dict(metas)
+        metas["data"] = {**metas.get("data", {}), **data["data"]}
+        meta_cache.set(session_id, (conversation, metas))
+    else:
+        meta_cache.pop(session_id)
+
+# 入站事件去重：重连或重复投递时，同一条消息（fingerprint）在窗口期内只处理一次
+# 去重窗口至少覆盖断线补发的时间范围，否则长时间断线后补发的消息会被重复转发
+dedup_config = config.get('dedup', {})
+backfill_config = config.get('backfill', {})
+seen_events = TTLCache(
+    maxsize=dedup_config.get('max_size', 10000),
+    ttl=max(
+        dedup_config.get('window', 600),
+        backfill_config.get('lookback', 3600) + backfill_config.get('grace', 30)
     )
-    
-@sio.on("disconnect")
-async def disconnect():
-    logging.warning("与 Crisp 服务器断开连接，尝试重新连接...")
-    retry_count = 0
-    max_retries = 5  # 最大重试次数
-    
-    while retry_count < max_retries:
-        try:
-            # 检查当前连接状态
-            if sio.connected:
-                logging.info("检测到现有连接，先断开...")
-                await sio.disconnect()
-            
-            await asyncio.sleep(5 * (retry_count + 1))  # 递增等待时间
-            
-            # 尝试重新连接
-            await sio.connect(
-                getCrispConnectEndpoints(),
-                transports="websocket",
-                wait_timeout=30,
-                socketio_path="socket.io"
-            )
-            
-            # 连接成功后重新认证
-            if sio.connected:
-                await sio.emit("authentication", {
-                    "tier": "plugin",
-                    "username": config["crisp"]["id"],
-                    "password": config["crisp"]["key"],
-                    "events": [
-                        "message:send",
-                        "session:set_data"
-                    ]
-                })
-                logging.info("重新连接成功并完成认证")
-                await callbackContext.bot.send_message(
-                    groupId,
-                    "已成功重新连接到 Crisp 服务器。",
-                )
-                break
-                
-        except Exception as e:
-            retry_count += 1
-            logging.error(f"重新连接尝试 {retry_count}/{max_retries} 失败: {str(e)}")
-            if retry_count >= max_retries:
-                logging.error("达到最大重试次数，停止重连")
-                await callbackContext.bot.send_message(
-                    groupId,
-                    "无法重新连接到 Crisp 服务器，请检查网络或手动重启服务。",
-                )
-                break
+)
+event_stats = {'received': 0, 'duplicates': 0}
+
+def isDuplicateEvent(data):
+    fingerprint = data.get("fingerprint")
+    if fingerprint is None:
+        return False
+    key = (data.get("session_id"), fingerprint)
+    if seen_events.get(key) is not None:
+        event_stats['duplicates'] += 1
+        logging.info(f"忽略重复的消息事件: {key}")
+        return True
+    seen_events.set(key, True)
+    return False
 
 @sio.on("message:send")
 async def messageForward(data):
+    rtm_supervisor.touch()
     if data["website_id"] != websiteId:
         return
-    await createSession(data)
-    await sendMessage(data)
+    event_stats['received'] += 1
+    forwardEvent(data)
+
+def forwardEvent(data):
+    """实时事件和断线补发共用的转发入口，重复的事件返回 False"""
+    if isDuplicateEvent(data):
+        return False
+    backfill.seen(data)
+    # 追踪从收到事件开始计时，排队等待也计入时间线
+    trace = tracer.new('inbound', session_id=data["session_id"], type=data.get("type"))
+    # 按会话排队处理：同一会话内保持顺序，不同会话之间并行，不阻塞 socket 事件处理
+    dispatcher.submit(data["session_id"], (trace, data))
+    return True
+
+async def processMessage(item):
+    trace, data = item
+    with tracer.run(trace):
+        trace.add('queue', trace.started_at, time.monotonic() - trace.started_at)
+        await createSession(data)
+        await sendMessage(data)
+
+# 慢消息追踪和按需性能分析
+tracing_config = config.get('tracing', {})
+tracer = Tracer(
+    size=tracing_config.get('slowest', 20),
+    slow_threshold=tracing_config.get('slow_threshold', 0)
+)
+profiler = Profiler(
+    max_seconds=tracing_config.get('profile_seconds', 60),
+    top=tracing_config.get('profile_top', 40)
+)
+
+# 断线补发：重连后拉取断线期间遗漏的访客消息
+backfill_task = None
+backfill = GapBackfill(
+    crisp,
+    websiteId,
+    forwardEvent,
+    lookback=backfill_config.get('lookback', 3600),
+    grace=backfill_config.get('grace', 30),
+    max_sessions=backfill_config.get('max_sessions', 1000),
+    max_pages=backfill_config.get('max_pages', 5),
+    max_concurrency=backfill_config.get('max_concurrency', 4)
+)
+
+dispatcher_config = config.get('dispatcher', {})
+dispatcher = SessionDispatcher(
+    processMessage,
+    max_concurrency=dispatcher_config.get('max_concurrency', 20),
+    idle_timeout=dispatcher_config.get('idle_timeout', 60)
+)
 
 
 # Meow!
-def getCrispConnectEndpoints():
-    url = "https://api.crisp.chat/v1/plugin/connect/endpoints"
-
-    authtier = base64.b64encode(
-        (config["crisp"]["id"] + ":" + config["crisp"]["key"]).encode("utf-8")
-    ).decode("utf-8")
-    payload = ""
-    headers = {"X-Crisp-Tier": "plugin", "Authorization": "Basic " + authtier}
-    response = requests.request("GET", url, headers=headers, data=payload)
-    endPoint = json.loads(response.text).get("data").get("socket").get("app")
-    return endPoint
+async def getCrispConnectEndpoints():
+    endpoints = await crisp.get_connect_endpoints()
+    return endpoints.get("socket").get("app")
+
+rtm_config = config.get('rtm', {})
+# RTM 地址缓存，重连时优先复用，接口异常时使用上次成功获取的地址
+rtm_endpoint = EndpointCache(
+    getCrispConnectEndpoints,
+    ttl=rtm_config.get('endpoint_ttl', 3600),
+    timeout=rtm_config.get('endpoint_timeout', 5),
+    min_interval=rtm_config.get('endpoint_min_interval', 30)
+)
+rtm_supervisor = RTMSupervisor(
+    sio,
+    rtm_endpoint.get,
+    invalidate=rtm_endpoint.invalidate,
+    on_connected=onRTMConnected,
+    on_disconnected=onRTMDisconnected,
+    backoff=rtm_config.get('backoff', 1),
+    max_backoff=rtm_config.get('max_backoff', 60),
+    heartbeat_interval=rtm_config.get('heartbeat_interval', 15),
+    stale_after=rtm_config.get('stale_after', 0),
+    connect_timeout=rtm_config.get('connect_timeout', 10),
+    min_uptime=rtm_config.get('min_uptime', 30)
+)
+
+# 队列深度、连接状态等瞬时值在导出指标时读取
+DISPATCHER_QUEUE = REGISTRY.gauge('crispbot_dispatcher_queue_depth', '会话队列中等待处理的事件总数')
+DISPATCHER_WORKERS = REGISTRY.gauge('crispbot_dispatcher_active_sessions', '有工作协程的会话数')
+OUTBOUND_QUEUE = REGISTRY.gauge('crispbot_outbound_queue_depth', 'Telegram 出站队列中等待发送的请求数')
+OUTBOUND_TOTAL = REGISTRY.counter('crispbot_outbound_requests_total', 'Telegram 出站请求结果', ('result',))
+RTM_STATE = REGISTRY.gauge('crispbot_rtm_state', 'Crisp RTM 连接状态，当前状态为 1', ('state',))
+RTM_OUTAGES = REGISTRY.counter('crispbot_rtm_outages_total', 'Crisp RTM 断线次数')
+RTM_RECONNECT_ATTEMPTS = REGISTRY.gauge('crispbot_rtm_reconnect_attempts', '当前这次断线已重试连接的次数')
+RTM_LAST_OUTAGE = REGISTRY.gauge('crispbot_rtm_last_outage_seconds', '最近一次断线的时长（秒）')
+RTM_EVENTS = REGISTRY.counter('crispbot_rtm_events_total', '收到的 message:send 事件', ('result',))
+BACKFILL_TOTAL = REGISTRY.counter('crispbot_backfill_total', '断线补发统计', ('stat',))
+CACHE_SIZE = REGISTRY.gauge('crispbot_cache_entries', '缓存条目数', ('cache',))
+CACHE_LOOKUPS = REGISTRY.counter('crispbot_cache_lookups_total', '缓存查询次数', ('cache', 'result'))
+SESSIONS_RESIDENT = REGISTRY.gauge('crispbot_sessions_resident', '常驻内存的会话数')
+SESSION_LOOKUPS = REGISTRY.counter('crispbot_session_lookups_total', '会话查询结果', ('result',))
+CARD_REFRESHES = REGISTRY.counter('crispbot_card_refreshes_total', '信息卡片刷新结果', ('result',))
+
+@REGISTRY.on_collect
+def collectMetrics():
+    DISPATCHER_QUEUE.set(sum(item['depth'] for item in dispatcher.stats().values()))
+    DISPATCHER_WORKERS.set(dispatcher.active_workers)
+    OUTBOUND_QUEUE.set(outbound.queue_depth)
+    for result, value in outbound.stats.items():
+        OUTBOUND_TOTAL.set(value, result=result)
+
+    status = rtm_supervisor.status()
+    for state in ('idle', 'connecting', 'connected', 'disconnected', 'backoff'):
+        RTM_STATE.set(1 if status['state'] == state else 0, state=state)
+    RTM_OUTAGES.set(status['outages'])
+    RTM_RECONNECT_ATTEMPTS.set(status['attempts'])
+    if status['last_outage'] is not None:
+        RTM_LAST_OUTAGE.set(status['last_outage'])
+    RTM_EVENTS.set(event_stats['received'] - event_stats['duplicates'], result='accepted')
+    RTM_EVENTS.set(event_stats['duplicates'], result='duplicate')
+    for stat, value in backfill.stats.items():
+        BACKFILL_TOTAL.set(value, stat=stat)
+
+    caches = {'meta': meta_cache, 'dedup': seen_events}
+    if answer_cache is not None:
+        caches['answer'] = answer_cache
+    for name, cache in caches.items():
+        stats = cache.stats()
+        CACHE_SIZE.set(stats['size'], cache=name)
+        CACHE_LOOKUPS.set(stats['hits'], cache=name, result='hit')
+        CACHE_LOOKUPS.set(stats['misses'], cache=name, result='miss')
+
+    SESSIONS_RESIDENT.set(len(session_registry))
+    for result, value in session_registry.stats.items():
+        SESSION_LOOKUPS.set(value, result=result)
+    for result, value in card_refresher.stats.items():
+        CARD_REFRESHES.set(value, result=result)
 
 # Connecting to Crisp RTM(WSS) Server
 async def exec(context: ContextTypes.DEFAULT_TYPE):
@@ -857,18 +1056,106 @@ async def exec(context: ContextTypes.DEFAULT_TYPE):
     # 输出启用的图床服务信息
     print_enabled_image_services()
 
-    # 发送启动消息到默认话题
-    await callbackContext.bot.send_message(
-        groupId,
-        text="机器人已启动"
+    # 发送启动消息到默认话题，同时连接 RTM，之后由 rtm_supervisor 一直保持连接
+    timeline.mark("正在连接 Crisp RTM")
+    await asyncio.gather(
+        outbound.call(
+            groupId,
+            callbackContext.bot.send_message,
+            groupId,
+            text="机器人已启动"
+        ),
+        rtm_supervisor.run()
     )
 
-    await sio.connect(
-        getCrispConnectEndpoints(),
-        transports="websocket",
-        wait_timeout=10,
+def adminMenu(keyboard):
+    """主话题管理菜单，在第一行之后插入可选的工具按钮"""
+    tools = []
+    if openai is not None and answer_cache is not None:
+        tools.append(InlineKeyboardButton("AI 缓存", callback_data="admin_ai_cache"))
+    tools.append(InlineKeyboardButton("性能诊断", callback_data="admin_diagnostics"))
+    if tools:
+        keyboard = keyboard[:1] + [tools] + keyboard[1:]
+    return InlineKeyboardMarkup(keyboard)
+
+def diagnosticsMenu():
+    """性能诊断菜单：慢消息追踪概况和性能分析状态"""
+    slowest = tracer.slowest()
+    lines = [f"已记录 {tracer.total} 条追踪，保留最慢的 {len(slowest)} 条"]
+    if slowest:
+        lines.append(f"最慢一条：{slowest[0].kind} {slowest[0].duration * 1000:.0f} ms")
+    cards = card_refresher.stats
+    lines.append(
+        f"信息卡片：编辑 {cards['sent']} 次，跳过 {cards['skipped']} 次，"
+        f"合并 {cards['coalesced']} 次，丢弃 {cards['dropped']} 次"
+    )
+    if profiler.running:
+        lines.append(f"性能分析进行中：{profiler.elapsed():.0f}/{profiler.max_seconds} 秒")
+    keyboard = [
+        [
+            InlineKeyboardButton("导出慢消息追踪", callback_data="admin_trace_dump"),
+            InlineKeyboardButton(
+                "停止性能分析" if profiler.running else "开始性能分析",
+                callback_data="admin_profile_toggle"
+            )
+        ],
+        [InlineKeyboardButton("返回", callback_data="admin_back_to_main")]
+    ]
+    return '\n'.join(lines), InlineKeyboardMarkup(keyboard)
+
+async def postReport(bot, name, content, caption):
+    """将诊断结果以文件形式发送到主话题"""
+    filename = f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+    await bot.send_document(groupId, document=content.encode('utf-8'), filename=filename, caption=caption)
+
+async def warmAnswerCache():
+    """从 FAQ 文件预热 AI 回复缓存
+
+    FAQ 文件可以是 {问题: 回复} 的映射，也可以是问题列表；没有给出回复的问题会调用 AI 生成。
+
+    Returns:
+        预热的条目数
+    """
+    faq_file = answer_cache_config.get("faq_file", "data/faq.yml")
+    with open(faq_file, 'r', encoding='utf-8') as f:
+        faq = yaml.safe_load(f) or []
+    items = list(faq.items()) if isinstance(faq, dict) else [(question, None) for question in faq]
+
+    semaphore = asyncio.Semaphore(4)
+
+    async def answer(question, reply):
+        if reply:
+            return question, reply
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                response = await openai.chat.completions.create(
+                    model="gpt-3.5-turbo",
+                    messages=[
+                        {"role": "system", "content": payload},
+                        {"role": "user", "content": question}
+                    ]
+                )
+                OPENAI_SECONDS.observe(time.monotonic() - started, call='warm', result='ok')
+                return question, response.choices[0].message.content
+            except Exception as e:
+                OPENAI_SECONDS.observe(time.monotonic() - started, call='warm', result='error')
+                logging.error(f"生成 FAQ 回复失败: {str(e)}")
+                return question, None
+
+    results = await asyncio.gather(*(answer(str(question), reply) for question, reply in items))
+    results = [(question, reply) for question, reply in results if reply]
+    answer_cache.warm(results)
+    return len(results)
+
+def answerCacheSummary():
+    stats = answer_cache.stats()
+    return (
+        f"AI 回复缓存：\n\n"
+        f"缓存条目：{stats['size']}\n"
+        f"命中：{stats['hits']}，未命中：{stats['misses']}\n"
+        f"命中率：{stats['hit_rate']:.1%}"
     )
-    await sio.wait() 
 
 # 添加新的回调处理函数
 async def handle_admin_callback(update, context):
@@ -993,7 +1280,7 @@ async def handle_admin_callback(update, context):
                 keyboard[-1] = [InlineKeyboardButton("恢复正常模式", callback_data="admin_normal_duty")]
             await query.message.edit_text(
                 "已连接到 Crisp 服务器。",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=adminMenu(keyboard)
             )
             await query.answer("已取消重启")
             
@@ -1036,7 +1323,7 @@ async def handle_admin_callback(update, context):
                 keyboard[-1] = [InlineKeyboardButton("恢复正常模式", callback_data="admin_normal_duty")]
             await query.message.edit_text(
                 "操作已取消。",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=adminMenu(keyboard)
             )
             # 清除用户状态
             context.user_data.clear()
@@ -1100,6 +1387,7 @@ async def handle_admin_callback(update, context):
                 
                 if keyword in config.get('autoreply', {}):
                     del config['autoreply'][keyword]
+                    rebuild_keyword_matcher()
                     # 保存配置
                     with open('config.yml', 'w', encoding='utf-8') as f:
                         yaml.dump(config, f, allow_unicode=True)
@@ -1145,7 +1433,7 @@ async def handle_admin_callback(update, context):
 
             await query.message.edit_text(
                 "已连接到 Crisp 服务器。",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=adminMenu(keyboard)
             )
             # 清除用户状态
             context.user_data.clear()
@@ -1154,6 +1442,7 @@ async def handle_admin_callback(update, context):
             # 删除下班自动回复
             if "" in config.get('autoreply', {}):
                 del config['autoreply'][""]
+                rebuild_keyword_matcher()
                 
                 # 保存到配置文件
                 with open('config.yml', 'w', encoding='utf-8') as f:
@@ -1177,7 +1466,7 @@ async def handle_admin_callback(update, context):
                 
                 await query.message.edit_text(
                     "已恢复正常模式。",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                    reply_markup=adminMenu(keyboard)
                 )
                 await query.answer()  # 添加这行来响应回调查询
 
@@ -1189,6 +1478,7 @@ async def handle_admin_callback(update, context):
                 # 使用配置文件中的下班回复内容
                 off_duty_message = config.get('off_duty_reply', "您好，当前为非工作时间。如有紧急事项，请发送邮件至 support@example.com 或在工作时间（周一至周五 9:00-18:00）再次联系我们。")
                 config['autoreply'][""] = off_duty_message
+                rebuild_keyword_matcher()
                 
                 # 保存到配置文件
                 with open('config.yml', 'w', encoding='utf-8') as f:
@@ -1213,10 +1503,68 @@ async def handle_admin_callback(update, context):
                 await query.message.edit_text(
                     f"已切换至下班模式，所有消息将自动回复：\n\n"
                     f"💬当前自动回复内容为: {off_duty_message}",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                    reply_markup=adminMenu(keyboard)
                 )
                 await query.answer()  # 添加这行来响应回调查询
 
+        elif query.data == "admin_ai_cache":
+            keyboard = [
+                [
+                    InlineKeyboardButton("从 FAQ 预热", callback_data="admin_ai_cache_warm"),
+                    InlineKeyboardButton("返回", callback_data="admin_back_to_main")
+                ]
+            ]
+            await query.message.edit_text(
+                answerCacheSummary(),
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+            await query.answer()
+
+        elif query.data == "admin_diagnostics":
+            text, markup = diagnosticsMenu()
+            await query.message.edit_text(text, reply_markup=markup)
+            await query.answer()
+
+        elif query.data == "admin_trace_dump":
+            if not tracer.slowest():
+                await query.answer("暂无追踪记录")
+                return
+            await query.answer("正在导出慢消息追踪...")
+            await postReport(context.bot, 'traces', tracer.dump(), "慢消息追踪")
+
+        elif query.data == "admin_profile_toggle":
+            if profiler.running:
+                await query.answer("正在停止性能分析...")
+                await postReport(context.bot, 'profile', profiler.stop(), "性能分析结果")
+            else:
+                async def onProfileTimeout(report):
+                    try:
+                        await postReport(context.bot, 'profile', report, "性能分析结果（已到达时长上限）")
+                    except Exception as e:
+                        logging.error(f"发送性能分析结果失败: {str(e)}")
+                profiler.start(on_timeout=onProfileTimeout)
+                await query.answer(f"性能分析已开始，最长 {profiler.max_seconds} 秒")
+            text, markup = diagnosticsMenu()
+            try:
+                await query.message.edit_text(text, reply_markup=markup)
+            except telegram.error.BadRequest as e:
+                if "Message is not modified" not in str(e):
+                    raise
+
+        elif query.data == "admin_ai_cache_warm":
+            await query.answer("正在预热 AI 缓存...")
+            try:
+                count = await warmAnswerCache()
+                result = f"✅ 已从 FAQ 预热 {count} 条回复"
+            except FileNotFoundError:
+                result = f"❌ 未找到 FAQ 文件：{answer_cache_config.get('faq_file', 'data/faq.yml')}"
+            await query.message.edit_text(
+                f"{result}\n\n{answerCacheSummary()}",
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("返回", callback_data="admin_back_to_main")
+                ]])
+            )
+
     except Exception as e:
         error_message = f"处理回调时出错: {str(e)}"
         logging.error(error_message)
@@ -1278,6 +1626,7 @@ async def handle_keyword_input(update, context):
                 if 'autoreply' not in config:
                     config['autoreply'] = {}
                 config['autoreply'][keyword] = reply
+                rebuild_keyword_matcher()
                 
                 # 保存到配置文件
                 with open('config.yml', 'w', encoding='utf-8') as f:
@@ -1311,7 +1660,7 @@ async def handle_keyword_input(update, context):
                     chat_id=context.user_data['original_chat_id'],
                     message_id=context.user_data['original_message_id'],
                     text=success_message,
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                    reply_markup=adminMenu(keyboard)
                 )
                 
                 # 删除用户的输入消息
@@ -1343,6 +1692,7 @@ async def handle_keyword_input(update, context):
             try:
                 # 更新配置
                 config['autoreply'][keyword] = new_reply
+                rebuild_keyword_matcher()
                 
                 # 保存到配置文件
                 with open('config.yml', 'w', encoding='utf-8') as f:
@@ -1377,7 +1727,7 @@ async def handle_keyword_input(update, context):
                     chat_id=context.user_data['original_chat_id'],
                     message_id=context.user_data['original_message_id'],
                     text=success_message,
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                    reply_markup=adminMenu(keyboard)
                 )
                 
                 # 删除用户的输入消息
@@ -1411,6 +1761,7 @@ async def handle_keyword_input(update, context):
                 # 如果当前处于下班模式,同时更新自动回复
                 if "" in config.get('autoreply', {}):
                     config['autoreply'][""] = new_reply
+                    rebuild_keyword_matcher()
                 
                 # 保存到配置文件
                 with open('config.yml', 'w', encoding='utf-8') as f:
@@ -1446,7 +1797,7 @@ async def handle_keyword_input(update, context):
                     chat_id=context.user_data['original_chat_id'],
                     message_id=context.user_data['original_message_id'],
                     text=success_message,
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                    reply_markup=adminMenu(keyboard)
                 )
                 
                 # 删除用户的输入消息
@@ -1495,7 +1846,7 @@ async def handle_keyword_input(update, context):
             chat_id=context.user_data['original_chat_id'],
             message_id=context.user_data['original_message_id'],
             text=f"❌ 操作失败: {error_message}\n\n请重试",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=adminMenu(keyboard)
         )
         # 清除用户状态
         context.user_data.clear() 
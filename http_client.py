@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+import random
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+import aiohttp
+
+
+class HttpStatusError(Exception):
+    """响应状态码为 4xx/5xx"""
+
+    def __init__(self, status, url, message):
+        super().__init__(f"HTTP {status} {url}: {message}")
+        self.status = status
+        self.url = url
+        self.message = message
+
+
+class HttpResponse:
+    """已读取完整响应体的 HTTP 响应"""
+
+    __slots__ = ('status', 'headers', 'body', 'url')
+
+    def __init__(self, status, headers, body, url=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.url = url
+
+    def text(self):
+        return self.body.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.body)
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise HttpStatusError(self.status, self.url, self.text()[:200])
+
+
+class HttpClient:
+    """所有出站 HTTP 请求共用的连接池客户端
+
+    - 同一个连接池复用长连接，并限制总连接数和每个主机的连接数
+    - 只有幂等请求会在网络错误、429 或 5xx 时重试，重试间隔为带随机抖动的指数退避，
+      服务器返回 Retry-After 时优先按其等待
+    - POST 等非幂等请求默认不重试；调用方确认请求可以安全重放（例如带有幂等键）时，
+      可以传入 idempotent=True
+
+    Args:
+        limit: 连接池总连接数
+        limit_per_host: 每个主机的最大连接数
+        timeout: 默认的单次请求超时时间（秒）
+        retries: 最大重试次数
+        backoff: 首次重试的基础等待时间（秒）
+        max_backoff: 单次重试的最长等待时间（秒）
+    """
+
+    IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'))
+    RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+    def __init__(self, limit=100, limit_per_host=10, timeout=10, retries=3, backoff=0.5, max_backoff=10):
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._session = None
+
+    def _get_session(self):
+        # aiohttp 的会话必须在事件循环中创建，因此延迟到首次请求时初始化
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._limit,
+                limit_per_host=self._limit_per_host,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self._timeout,
+                headers={"User-Agent": "crisp-telegram-bot"}
+            )
+        return self._session
+
+    def _delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        # full jitter：在 [0, backoff * 2^attempt] 内随机等待，避免多个请求同时重试
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    @staticmethod
+    def _retry_after(headers):
+        value = headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    async def request(self, method, url, *, idempotent=None, timeout=None, **kwargs):
+        """发送请求并读取完整响应体
+
+        Args:
+            idempotent: 是否允许重试，默认只有 GET/HEAD/OPTIONS/PUT/DELETE 会重试
+            timeout: 覆盖默认的超时时间（秒）
+            其余参数直接传给 aiohttp（params、json、data、headers、auth 等），
+            允许重试时 data 必须可以重复发送（不能是 FormData 或流）
+
+        Returns:
+            HttpResponse，状态码不在重试范围内时直接返回，由调用方判断
+        """
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in self.IDEMPOTENT_METHODS
+        if timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+        attempts = self.retries + 1 if idempotent else 1
+
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            try:
+                async with self._get_session().request(method, url, **kwargs) as response:
+                    body = await response.read()
+                    if response.status in self.RETRY_STATUSES and not last:
+                        delay = self._delay(attempt, self._retry_after(response.headers))
+                        logging.warning(f"{method} {url} 返回 {response.status}，{delay:.1f} 秒后重试")
+                        await asyncio.sleep(delay)
+                        continue
+                    return HttpResponse(response.status, response.headers, body, str(response.url))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if last:
+                    raise
+                delay = self._delay(attempt)
+                logging.warning(f"{method} {url} 请求失败: {str(e) or type(e).__name__}，{delay:.1f} 秒后重试")
+                await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def stream(self, method, url, *, timeout=None, **kwargs):
+        """以流的方式读取响应体，返回 aiohttp 的响应对象，不做重试"""
+        if timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+        async with self._get_session().request(method, url, **kwargs) as response:
+            yield response
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
@@ -0,0 +1,351 @@
+import asyncio
+import io
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from cache import DelayedSave, TTLCache
+from metrics import REGISTRY
+from tracing import span
+
+UPLOAD_SECONDS = REGISTRY.histogram('crispbot_image_upload_seconds', '各图床上传耗时（秒）', ('host', 'result'))
+
+
+class ImageUploader:
+    """异步图床上传
+
+    支持两种模式（image_upload.mode）：
+    - sequential：按配置顺序依次尝试已启用的图床，成功即返回（默认，请求次数最少）
+    - race：同时（或每隔 hedge_delay 秒依次）向前 race_hosts 个图床发起上传，
+      采用最先返回的有效链接，并取消其余请求
+
+    Args:
+        upload_config: 配置中的 image_upload 部分
+        http: 共用的 HttpClient
+    """
+
+    def __init__(self, upload_config, http):
+        self._config = upload_config or {}
+        self._http = http
+        self.mode = self._config.get('mode', 'sequential')
+        self.hedge_delay = self._config.get('hedge_delay', 0)
+        self.race_hosts = self._config.get('race_hosts', 0)
+        self._timeout = self._config.get('timeout', 10)
+        self._preprocess = self._config.get('preprocess', {})
+        # 解码、缩放、重新压缩都在线程池中进行，不阻塞事件循环
+        self._executor = ThreadPoolExecutor(
+            max_workers=self._preprocess.get('workers', 2),
+            thread_name_prefix='image'
+        )
+
+    def enabled_hosts(self):
+        """返回已启用且配置完整的图床，顺序与原先的轮询顺序一致"""
+        enabled_services = self._config.get('enabled_services', {})
+        hosts = []
+        if enabled_services.get('imgbb', True):
+            if self._config.get('imgbb_api_key'):
+                hosts.append('imgbb')
+            else:
+                logging.warning("ImgBB API密钥未设置")
+        if enabled_services.get('sang_pub', False):
+            hosts.append('sang_pub')
+        if enabled_services.get('cloudinary', False):
+            cloudinary_config = self._config.get('cloudinary', {})
+            if cloudinary_config.get('cloud_name') and cloudinary_config.get('upload_preset'):
+                hosts.append('cloudinary')
+            else:
+                logging.warning("Cloudinary配置不完整")
+        if enabled_services.get('telegraph', False):  # 默认设置为禁用
+            hosts.append('telegraph')
+        return hosts
+
+    async def upload(self, image_bytes):
+        """上传图片并返回图片链接，所有图床都失败时抛出异常"""
+        hosts = self.enabled_hosts()
+        if not hosts:
+            raise Exception("没有可用的图床服务")
+
+        image_bytes, img_format = await asyncio.get_running_loop().run_in_executor(
+            self._executor,
+            prepare_image,
+            image_bytes,
+            self._preprocess.get('max_dimension', 2048),
+            self._preprocess.get('max_bytes', 1048576),
+            self._preprocess.get('quality', 85)
+        )
+
+        if self.mode == 'race':
+            return await self._race(hosts, image_bytes, img_format)
+
+        for host in hosts:
+            try:
+                return await self._upload_to(host, image_bytes, img_format)
+            except Exception as e:
+                logging.error(f"上传到 {host} 失败: {str(e)}")
+        raise Exception("所有启用的图片上传API都失败了")
+
+    async def _race(self, hosts, image_bytes, img_format):
+        if self.race_hosts:
+            hosts = hosts[:self.race_hosts]
+        pending_hosts = list(hosts)
+        running = {}
+
+        def launch():
+            host = pending_hosts.pop(0)
+            task = asyncio.create_task(self._upload_to(host, image_bytes, img_format))
+            running[task] = host
+
+        launch()
+        if not self.hedge_delay:
+            while pending_hosts:
+                launch()
+
+        try:
+            while running:
+                timeout = self.hedge_delay if pending_hosts else None
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 对冲：等待超过 hedge_delay 仍未返回，追加下一个图床
+                    launch()
+                    continue
+                for task in done:
+                    host = running.pop(task)
+                    try:
+                        return task.result()
+                    except Exception as e:
+                        logging.error(f"上传到 {host} 失败: {str(e)}")
+                        if pending_hosts:
+                            launch()
+        finally:
+            for task in running:
+                task.cancel()
+        raise Exception("所有启用的图片上传API都失败了")
+
+    async def _upload_to(self, host, image_bytes, img_format):
+        started = time.monotonic()
+        result = 'error'
+        try:
+            with span(f"image.{host}"):
+                image_url = await self._post(host, image_bytes, img_format)
+            result = 'ok'
+            return image_url
+        except asyncio.CancelledError:
+            # 竞速模式下被更快的图床取消
+            result = 'cancelled'
+            raise
+        finally:
+            UPLOAD_SECONDS.observe(time.monotonic() - started, host=host, result=result)
+
+    async def _post(self, host, image_bytes, img_format):
+        logging.info(f"开始尝试上传到 {host}")
+        content_type = f'image/{img_format}'
+
+        if host == 'imgbb':
+            form = aiohttp.FormData()
+            form.add_field('image', image_bytes, filename=f'image.{img_format}', content_type=content_type)
+            params = {'key': self._config['imgbb_api_key']}
+            if self._config.get('imgbb_expiration', 0):
+                params['expiration'] = self._config['imgbb_expiration']
+            # 上传请求不是幂等的，失败时交给下一个图床而不是重试
+            response = await self._http.request(
+                'POST', "https://api.imgbb.com/1/upload", data=form, params=params, timeout=self._timeout
+            )
+            response.raise_for_status()
+            image_url = response.json()['data']['url']
+
+        elif host == 'cloudinary':
+            # 使用 multipart 直接上传原始字节，避免 base64 带来的约 33% 体积膨胀
+            cloudinary_config = self._config['cloudinary']
+            form = aiohttp.FormData()
+            form.add_field('file', image_bytes, filename=f'image.{img_format}', content_type=content_type)
+            form.add_field('upload_preset', cloudinary_config['upload_preset'])
+            url = f"https://api.cloudinary.com/v1_1/{cloudinary_config['cloud_name']}/image/upload"
+            response = await self._http.request('POST', url, data=form, timeout=self._timeout)
+            response.raise_for_status()
+            image_url = response.json()['secure_url']
+
+        else:
+            form = aiohttp.FormData()
+            form.add_field('file', image_bytes, filename=f'image.{img_format}', content_type=content_type)
+            url = "https://file.sang.pub/api/upload" if host == 'sang_pub' else "https://telegra.ph/upload"
+            response = await self._http.request('POST', url, data=form, timeout=self._timeout)
+            response.raise_for_status()
+            if host == 'sang_pub':
+                image_url = response.text().strip()
+            else:
+                image_url = 'https://telegra.ph' + response.json()[0]['src']
+
+        if not image_url or not image_url.startswith('http'):
+            raise ValueError(f"无效的图片URL: {image_url}")
+
+        logging.info(f"成功上传到 {host}: {image_url}")
+        return image_url
+
+
+
+class UploadCache:
+    """已上传图片的两级缓存
+
+    - 第一级：Telegram file_unique_id -> 图片链接，命中时连下载都可以省去
+    - 第二级：图片内容 SHA-256 -> 图片链接，转发或重新发送的相同图片不再重复上传
+
+    条目的有效期应短于图床上的保存时间，索引文件条目数受 max_size 限制，
+    变更在 save_delay 秒后于线程池中批量写入索引文件。
+
+    Args:
+        path: 索引文件路径，为 None 时只保存在内存
+        max_size: 每一级最多保存的条目数
+        ttl: 条目有效期（秒），为 None 时不过期
+        save_delay: 变更写入索引文件前的等待时间（秒）
+    """
+
+    def __init__(self, path=None, max_size=2000, ttl=None, save_delay=5):
+        self._path = path
+        self.ttl = ttl
+        self._files = TTLCache(maxsize=max_size, ttl=ttl)
+        self._digests = TTLCache(maxsize=max_size, ttl=ttl)
+        self._saver = DelayedSave(self._index, self._write, save_delay)
+        self._load()
+
+    def get_by_file_id(self, file_unique_id):
+        entry = self._files.get(file_unique_id)
+        return entry[0] if entry is not None else None
+
+    def get_by_digest(self, digest):
+        entry = self._digests.get(digest)
+        return entry[0] if entry is not None else None
+
+    def put(self, url, file_unique_id=None, digest=None):
+        created = time.time()
+        if digest:
+            existing = self._digests.get(digest)
+            if existing is not None and existing[0] == url:
+                # 链接来自内容缓存时沿用其创建时间，避免超过图床上的保存期限
+                created = existing[1]
+            else:
+                self._digests.set(digest, (url, created))
+        if file_unique_id:
+            remaining = self.ttl - (time.time() - created) if self.ttl else None
+            # 已到期的链接不再记录（ttl 为 0 对 TTLCache 表示永不过期）
+            if remaining is None or remaining > 0:
+                self._files.set(file_unique_id, (url, created), ttl=remaining)
+        self._save()
+
+    def stats(self):
+        return {'files': self._files.stats(), 'digests': self._digests.stats()}
+
+    def _load(self):
+        if not self._path:
+            return
+        try:
+            with open(self._path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.error(f"加载图片上传缓存失败: {str(e)}")
+            return
+
+        now = time.time()
+        for name, cache in (('files', self._files), ('digests', self._digests)):
+            for key, url, created in index.get(name, []):
+                remaining = self.ttl - (now - created) if self.ttl else None
+                if remaining is None or remaining > 0:
+                    cache.set(key, (url, created), ttl=remaining)
+
+    def _save(self):
+        if self._path:
+            self._saver.mark()
+
+    async def flush(self):
+        """立即写入尚未保存的变更"""
+        await self._saver.flush()
+
+    def _index(self):
+        return {
+            name: [[key, url, created] for key, (url, created) in cache.items()]
+            for name, cache in (('files', self._files), ('digests', self._digests))
+        }
+
+    def _write(self, index):
+        try:
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_path = self._path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(index, f)
+            os.replace(temp_path, self._path)
+        except Exception as e:
+            logging.error(f"保存图片上传缓存失败: {str(e)}")
+
+
+def sniff_format(image_bytes):
+    """根据文件头的魔数判断图片格式，无需解码图片，无法识别时按 jpeg 处理"""
+    header = bytes(image_bytes[:16])
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    if header.startswith(b'BM'):
+        return 'bmp'
+    logging.warning("无法识别图片格式，按 jpeg 处理")
+    return 'jpeg'
+
+
+def prepare_image(image_bytes, max_dimension=0, max_bytes=0, quality=85):
+    """按需缩小并重新压缩图片（CPU 密集，应在线程池中调用）
+
+    只有尺寸超过 max_dimension 或体积超过 max_bytes 时才会处理，GIF 保持原样以保留动画。
+
+    Returns:
+        (图片字节, 格式)
+    """
+    img_format = sniff_format(image_bytes)
+    if img_format == 'gif' or not (max_dimension or max_bytes):
+        return image_bytes, img_format
+
+    too_large = max_bytes and len(image_bytes) > max_bytes
+    try:
+        # Pillow 只在第一次需要处理图片时加载
+        from PIL import Image
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            # Image.open 只读取文件头，尺寸满足要求且体积不超限时无需解码
+            oversized = max_dimension and max(img.size) > max_dimension
+            if not (oversized or too_large):
+                return image_bytes, img_format
+
+            if oversized:
+                img.thumbnail((max_dimension, max_dimension))
+            has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+
+            if has_alpha:
+                output = io.BytesIO()
+                img.save(output, format='PNG', optimize=True)
+                result, result_format = output.getvalue(), 'png'
+            else:
+                img = img.convert('RGB')
+                result_format = 'jpeg'
+                while True:
+                    output = io.BytesIO()
+                    img.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+                    result = output.getvalue()
+                    if not max_bytes or len(result) <= max_bytes or quality <= 40:
+                        break
+                    quality -= 15
+    except Exception as e:
+        logging.error(f"图片预处理失败，使用原图上传: {str(e)}")
+        return image_bytes, img_format
+
+    if len(result) >= len(image_bytes) and not oversized:
+        return image_bytes, img_format
+    logging.info(f"图片预处理完成: {len(image_bytes)} -> {len(result)} 字节")
+    return result, result_format
@@ -0,0 +1,125 @@
+from collections import deque
+
+
+class KeywordMatcher:
+    """基于 Aho-Corasick 自动机的自动回复关键字匹配
+
+    关键字表格式与配置中的 autoreply 一致：{"关键字1|关键字2": "回复内容"}。
+    构建后只读，关键字变化时应整体重建一个新实例再替换引用。
+
+    匹配优先级：
+    1. 命中的关键字越长越优先
+    2. 长度相同时，配置中靠前的条目优先
+    3. 空关键字（例如下班模式的 ""）作为兜底，仅在其他关键字都未命中时生效
+    """
+
+    def __init__(self, table):
+        self._replies = []
+        self._fallback = None
+        # 每个节点：子节点表、失败指针、该节点可输出的最佳匹配 (长度, -优先级, 回复索引)
+        self._goto = [{}]
+        self._fail = [0]
+        self._best = [None]
+
+        for priority, (keywords, reply) in enumerate((table or {}).items()):
+            index = len(self._replies)
+            self._replies.append(reply)
+            for key in str(keywords).split("|"):
+                if key == "":
+                    if self._fallback is None:
+                        self._fallback = index
+                    continue
+                self._add(key, (len(key), -priority, index))
+
+        self._build()
+
+    def _add(self, key, output):
+        node = 0
+        for char in key:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._best.append(None)
+                self._goto[node][char] = next_node
+            node = next_node
+        if self._best[node] is None or output > self._best[node]:
+            self._best[node] = output
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                # 合并失败链上的输出，匹配时无需再沿失败链回溯
+                inherited = self._best[self._fail[child]]
+                if inherited is not None and (self._best[child] is None or inherited > self._best[child]):
+                    self._best[child] = inherited
+                queue.append(child)
+
+    def match(self, content):
+        """返回 (是否命中, 回复内容)"""
+        goto = self._goto
+        fail = self._fail
+        best_outputs = self._best
+        best = None
+        node = 0
+        for char in content or "":
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            output = best_outputs[node]
+            if output is not None and (best is None or output > best):
+                best = output
+
+        if best is not None:
+            return True, self._replies[best[2]]
+        if self._fallback is not None:
+            return True, self._replies[self._fallback]
+        return False, None
+
+
+if __name__ == "__main__":
+    # 基准测试：python keyword_matcher.py
+    import random
+    import time
+
+    random.seed(0)
+    # 常用汉字范围内随机生成关键字和消息，绝大多数消息不会命中，即逐条匹配的最坏情况
+    alphabet = [chr(code) for code in range(0x4E00, 0x4E00 + 3000)]
+    table = {
+        "|".join("".join(random.choices(alphabet, k=random.randint(2, 6))) for _ in range(random.randint(1, 3))): f"回复{i}"
+        for i in range(10000)
+    }
+    messages = ["".join(random.choices(alphabet, k=random.randint(10, 200))) for _ in range(1000)]
+
+    def naive(content):
+        for x in table:
+            for key in x.split("|"):
+                if key in content:
+                    return True, table[x]
+        return False, None
+
+    start = time.perf_counter()
+    matcher = KeywordMatcher(table)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for message in messages:
+        naive(message)
+    naive_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for message in messages:
+        matcher.match(message)
+    matcher_time = time.perf_counter() - start
+
+    print(f"关键字条目: {len(table)}，消息: {len(messages)}")
+    print(f"自动机构建: {build_time * 1000:.1f} ms")
+    print(f"逐个子串匹配: {naive_time * 1000:.1f} ms")
+    print(f"自动机匹配: {matcher_time * 1000:.1f} ms（{naive_time / matcher_time:.1f}x）")
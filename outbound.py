@@ -0,0 +1,235 @@
+import asyncio
+import contextvars
+import datetime
+import itertools
+import logging
+import time
+
+import telegram
+
+from metrics import REGISTRY
+import tracing
+
+TELEGRAM_SECONDS = REGISTRY.histogram('crispbot_telegram_api_seconds', 'Telegram Bot API 调用耗时（秒）', ('method',))
+TELEGRAM_ERRORS = REGISTRY.counter('crispbot_telegram_api_errors_total', 'Telegram Bot API 调用失败次数', ('method', 'error'))
+TELEGRAM_QUEUE_WAIT = REGISTRY.histogram('crispbot_telegram_queue_wait_seconds', 'Telegram 请求排队等待时间（秒）', ('priority',))
+# 发送优先级，数值越小越优先
+PRIORITY_VISITOR = 0   # 访客消息、系统通知
+PRIORITY_PREVIEW = 1   # AI 回复生成过程中的预览编辑
+PRIORITY_CARD = 2      # 信息卡片编辑
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积累 capacity 个"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, now):
+        """距离可以取出一个令牌还需等待的秒数，0 表示立即可用"""
+        self._refill(now)
+        wait = 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+        return max(wait, self._blocked_until - now)
+
+    def take(self, now):
+        self._refill(now)
+        self._tokens -= 1
+
+    def block(self, seconds):
+        """Telegram 返回 retry_after 时，在指定时间内不再发送，并清空已积累的令牌"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class _Job:
+    __slots__ = ('priority', 'seq', 'chat_id', 'method', 'args', 'kwargs',
+                 'key', 'stale_after', 'deadline', 'attempts', 'future', 'enqueued_at', 'trace')
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundScheduler:
+    """Telegram 出站请求调度器
+
+    所有发往 Telegram 的请求按优先级排队，同时受每个聊天和全局两级令牌桶限速：
+    - 优先发送访客消息，其次是 AI 预览，最后是信息卡片编辑
+    - 遇到 429 时按 retry_after 暂停该聊天的发送，并把请求放回队列重试
+    - 设置了 stale_after 的请求排队超时后直接丢弃；同一 key 的新请求会替换仍在排队的旧请求
+
+    Args:
+        chat_rate: 每个聊天在 chat_period 秒内允许发送的请求数
+        chat_period: 聊天限速的统计周期（秒）
+        chat_burst: 每个聊天允许的突发请求数
+        global_rate: 全局每秒允许发送的请求数
+        max_retries: 遇到 429 时的最大重试次数
+    """
+
+    def __init__(self, chat_rate=20, chat_period=60, chat_burst=10, global_rate=30, max_retries=3):
+        self._chat_rate = chat_rate / chat_period
+        self._chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}
+        self.max_retries = max_retries
+        self._jobs = []
+        self._keys = {}
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._worker = None
+        self.stats = {'sent': 0, 'failed': 0, 'retried': 0, 'stale': 0, 'superseded': 0}
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    async def call(self, chat_id, method, /, *args, priority=PRIORITY_VISITOR, stale_after=None, key=None, **kwargs):
+        """排队调用 Bot API 方法并等待结果
+
+        chat_id 和 method 只能按位置传入，其余关键字参数（包括 chat_id=...）原样传给 method。
+
+        Args:
+            chat_id: 请求所属的聊天，用于按聊天限速
+            method: Bot API 方法，例如 bot.send_message、message.edit_text
+            priority: 发送优先级
+            stale_after: 排队超过该秒数仍未发送时丢弃
+            key: 相同 key 的新请求会替换仍在排队的旧请求
+
+        Returns:
+            Bot API 的返回值；请求因过期或被替换而丢弃时返回 None
+        """
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._worker is None or self._worker.done():
+            # 调度任务在空白上下文中创建，避免继承首个调用方的追踪
+            self._worker = contextvars.Context().run(asyncio.create_task, self._run())
+
+        job = _Job()
+        job.priority = priority
+        job.seq = next(self._seq)
+        job.chat_id = chat_id
+        job.method = method
+        job.args = args
+        job.kwargs = kwargs
+        job.key = key
+        job.stale_after = stale_after
+        job.deadline = time.monotonic() + stale_after if stale_after is not None else None
+        job.attempts = 0
+        job.enqueued_at = time.monotonic()
+        # 发送在调度器的任务中进行，需要记下调用方所属的追踪
+        job.trace = tracing.current()
+        job.future = asyncio.get_running_loop().create_future()
+
+        if key is not None:
+            previous = self._keys.get(key)
+            if previous is not None and previous in self._jobs:
+                self._discard(previous, 'superseded')
+            self._keys[key] = job
+
+        self._jobs.append(job)
+        self._wakeup.set()
+        return await job.future
+
+    def _discard(self, job, reason):
+        self._jobs.remove(job)
+        if self._keys.get(job.key) is job:
+            del self._keys[job.key]
+        if not job.future.done():
+            job.future.set_result(None)
+        self.stats[reason] += 1
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            for job in list(self._jobs):
+                if job.future.done():
+                    # 调用方已取消
+                    self._jobs.remove(job)
+                elif job.deadline is not None and now > job.deadline:
+                    self._discard(job, 'stale')
+
+            ready, wait = None, None
+            global_delay = self._global.delay(now)
+            for job in sorted(self._jobs):
+                delay = max(global_delay, self._bucket(job.chat_id).delay(now))
+                if delay <= 0:
+                    ready = job
+                    break
+                wait = delay if wait is None else min(wait, delay)
+
+            if ready is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._jobs.remove(ready)
+            if self._keys.get(ready.key) is ready:
+                del self._keys[ready.key]
+            self._global.take(now)
+            self._bucket(ready.chat_id).take(now)
+            asyncio.create_task(self._send(ready))
+
+    async def _send(self, job):
+        name = getattr(job.method, '__name__', 'unknown')
+        started = time.monotonic()
+        TELEGRAM_QUEUE_WAIT.observe(started - job.enqueued_at, priority=job.priority)
+        if job.trace is not None:
+            job.trace.add('telegram.queue', job.enqueued_at, started - job.enqueued_at)
+        try:
+            with tracing.span(f"telegram.{name}", job.trace):
+                try:
+                    result = await job.method(*job.args, **job.kwargs)
+                finally:
+                    TELEGRAM_SECONDS.observe(time.monotonic() - started, method=name)
+        except telegram.error.RetryAfter as e:
+            TELEGRAM_ERRORS.inc(method=name, error='RetryAfter')
+            retry_after = e.retry_after
+            if isinstance(retry_after, datetime.timedelta):
+                retry_after = retry_after.total_seconds()
+            logging.warning(f"Telegram 限流，聊天 {job.chat_id} 暂停发送 {retry_after} 秒")
+            self._bucket(job.chat_id).block(retry_after)
+            if job.attempts < self.max_retries and not job.future.done():
+                if job.key is not None and job.key in self._keys:
+                    # 等待期间已有同 key 的新请求排队，不再重试旧请求
+                    job.future.set_result(None)
+                    self.stats['superseded'] += 1
+                    return
+                job.attempts += 1
+                job.enqueued_at = time.monotonic()
+                # 过期时间从恢复发送时算起，并重新登记 key 以便被更新的请求替换
+                if job.stale_after is not None:
+                    job.deadline = job.enqueued_at + retry_after + job.stale_after
+                if job.key is not None:
+                    self._keys[job.key] = job
+                self.stats['retried'] += 1
+                self._jobs.append(job)
+                self._wakeup.set()
+                return
+            self.stats['failed'] += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(method=name, error=type(e).__name__)
+            self.stats['failed'] += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.stats['sent'] += 1
+            if not job.future.done():
+                job.future.set_result(result)
+
+    @property
+    def queue_depth(self):
+        return len(self._jobs)
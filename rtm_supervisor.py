@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import random
+import time
+
+
+class EndpointCache:
+    """RTM 地址缓存
+
+    地址在 ttl 秒内直接复用；过期或被标记失效后重新获取，获取失败或超时时退回上一次成功的地址。
+    同一时间只有一个请求在获取地址，两次获取之间至少间隔 min_interval 秒，避免重连风暴频繁请求接口。
+
+    Args:
+        fetch: async () -> url
+        ttl: 地址有效期（秒）
+        timeout: 单次获取的超时时间（秒）
+        min_interval: 两次获取之间的最小间隔（秒）
+    """
+
+    def __init__(self, fetch, ttl=3600, timeout=5, min_interval=30):
+        self._fetch = fetch
+        self.ttl = ttl
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self._value = None
+        self._expires_at = 0
+        self._fetched_at = None
+        self._lock = None
+        self.stats = {'hits': 0, 'fetches': 0, 'fallbacks': 0}
+
+    def invalidate(self):
+        self._expires_at = 0
+
+    async def get(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            now = time.monotonic()
+            throttled = self._fetched_at is not None and now - self._fetched_at < self.min_interval
+            if self._value is not None and (now < self._expires_at or throttled):
+                self.stats['hits'] += 1
+                return self._value
+
+            self._fetched_at = now
+            self.stats['fetches'] += 1
+            try:
+                value = await asyncio.wait_for(self._fetch(), timeout=self.timeout)
+            except Exception as e:
+                if self._value is None:
+                    raise
+                self.stats['fallbacks'] += 1
+                logging.warning(f"获取 RTM 地址失败，使用上次成功的地址: {str(e) or type(e).__name__}")
+                return self._value
+
+            self._value = value
+            self._expires_at = time.monotonic() + self.ttl
+            return value
+
+
+class RTMSupervisor:
+    """Crisp RTM 连接监管
+
+    唯一负责 socket 连接的后台任务（socket.io 客户端自身的重连需关闭）：
+    - 每次连接前重新解析 RTM 地址
+    - 连接失败，或连接建立后不到 min_uptime 秒就断开时，按带随机抖动的指数退避重试，不会放弃；
+      连接保持超过 min_uptime 秒后才重置退避
+    - 心跳检查：socket 已断开但未收到断开事件，或超过 stale_after 秒没有收到任何事件时主动重连
+    - 通过 status() 暴露连接状态、距离下次重试的时间以及最近一次中断的时长
+
+    Args:
+        sio: socketio.AsyncClient（reconnection=False）
+        resolve: async () -> url，获取 RTM 地址
+        invalidate: () -> None，连接失败后调用，提示下次重新获取地址
+        on_connected: async (outage) -> None，连接成功后调用，outage 为中断秒数，首次连接时为 None
+        on_disconnected: async () -> None，连接断开后调用
+        backoff: 首次重试的等待时间（秒）
+        max_backoff: 最长重试间隔（秒）
+        heartbeat_interval: 心跳检查间隔（秒）
+        stale_after: 超过该秒数没有收到事件视为连接失效，0 表示不检查
+        connect_timeout: 单次连接的超时时间（秒）
+        min_uptime: 连接至少保持该秒数才视为恢复正常（秒）
+    """
+
+    def __init__(self, sio, resolve, invalidate=None, on_connected=None, on_disconnected=None, backoff=1,
+                 max_backoff=60, heartbeat_interval=15, stale_after=0, connect_timeout=10, min_uptime=30):
+        self._sio = sio
+        self._resolve = resolve
+        self._invalidate = invalidate
+        self._on_connected = on_connected
+        self._on_disconnected = on_disconnected
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self.connect_timeout = connect_timeout
+        self.min_uptime = min_uptime
+
+        self.state = 'idle'
+        self.attempts = 0
+        self.outages = 0
+        self.last_outage = None
+        self._connected_at = None
+        self._disconnected_at = None
+        self._next_retry_at = None
+        self._last_activity = time.monotonic()
+
+    def touch(self):
+        """收到 RTM 事件时调用，用于判断连接是否失效"""
+        self._last_activity = time.monotonic()
+
+    def _delay(self):
+        # equal jitter：在退避时间的 50%~100% 之间随机，避免多个实例同时重连
+        delay = min(self.max_backoff, self.backoff * 2 ** self.attempts)
+        return delay * random.uniform(0.5, 1)
+
+    async def run(self):
+        """持续保持连接，直到任务被取消"""
+        while True:
+            self.state = 'connecting'
+            try:
+                url = await self._resolve()
+                await self._sio.connect(
+                    url,
+                    transports="websocket",
+                    wait_timeout=self.connect_timeout
+                )
+            except Exception as e:
+                logging.error(f"连接 Crisp RTM 失败: {str(e)}")
+                if self._invalidate is not None:
+                    self._invalidate()
+                await self._backoff()
+                continue
+
+            await self._connected()
+            await self._hold()
+            uptime = time.monotonic() - self._connected_at
+            await self._disconnected()
+            if uptime >= self.min_uptime:
+                self.attempts = 0
+            else:
+                # 连接后立即被断开（例如认证失败）时同样退避，避免无间隔地反复重连
+                logging.warning(f"Crisp RTM 连接仅保持 {uptime:.1f} 秒")
+                await self._backoff()
+
+    async def _connected(self):
+        outage = None
+        if self._disconnected_at is not None:
+            outage = time.monotonic() - self._disconnected_at
+            self.last_outage = outage
+            logging.info(f"已重新连接 Crisp RTM，中断 {outage:.1f} 秒，重试 {self.attempts} 次")
+        self.state = 'connected'
+        self._connected_at = time.monotonic()
+        self._disconnected_at = None
+        self._next_retry_at = None
+        self.touch()
+        await self._callback(self._on_connected, outage)
+
+    async def _hold(self):
+        """等待连接断开，或由心跳检查发现连接失效"""
+        waiter = asyncio.create_task(self._sio.wait())
+        watchdog = asyncio.create_task(self._watchdog())
+        try:
+            await asyncio.wait((waiter, watchdog), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (waiter, watchdog):
+                task.cancel()
+        if self._sio.connected:
+            try:
+                await self._sio.disconnect()
+            except Exception as e:
+                logging.error(f"断开 Crisp RTM 失败: {str(e)}")
+
+    async def _watchdog(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            if not self._sio.connected:
+                logging.warning("心跳检查发现 Crisp RTM 已断开")
+                return
+            idle = time.monotonic() - self._last_activity
+            if self.stale_after and idle > self.stale_after:
+                logging.warning(f"Crisp RTM 已 {idle:.0f} 秒没有收到事件，主动重连")
+                return
+
+    async def _disconnected(self):
+        self.state = 'disconnected'
+        self.outages += 1
+        self._disconnected_at = time.monotonic()
+        logging.warning("与 Crisp RTM 断开连接，准备重新连接")
+        await self._callback(self._on_disconnected)
+
+    async def _backoff(self):
+        delay = self._delay()
+        self.attempts += 1
+        self.state = 'backoff'
+        self._next_retry_at = time.monotonic() + delay
+        logging.info(f"{delay:.1f} 秒后第 {self.attempts} 次重试连接 Crisp RTM")
+        await asyncio.sleep(delay)
+
+    @staticmethod
+    async def _callback(callback, *args):
+        if callback is None:
+            return
+        try:
+            await callback(*args)
+        except Exception as e:
+            logging.error(f"RTM 状态回调失败: {str(e)}")
+
+    def status(self):
+        """当前连接状态，时间均为秒"""
+        now = time.monotonic()
+        return {
+            'state': self.state,
+            'connected_for': now - self._connected_at if self.state == 'connected' else None,
+            'down_for': now - self._disconnected_at if self._disconnected_at is not None else None,
+            'retry_in': max(0.0, self._next_retry_at - now) if self._next_retry_at is not None else None,
+            'attempts': self.attempts,
+            'outages': self.outages,
+            'last_outage': self.last_outage
+        }
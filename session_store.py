@@ -0,0 +1,391 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+
+import yaml
+
+# 每条会话记录保存的字段及默认值
+FIELDS = {
+    'topic_id': None,
+    'message_id': None,
+    'enable_ai': False,
+    'completed': False
+}
+
+
+class SessionStore(ABC):
+    """会话存储接口
+
+    记录格式与原 session_mapping.yml 一致：
+    {session_id: {'topic_id': ..., 'message_id': ..., 'enable_ai': ..., 'completed': ...}}
+    """
+
+    @abstractmethod
+    def get(self, session_id):
+        """按会话 ID 查找，返回记录字典，找不到时返回 None"""
+
+    @abstractmethod
+    def get_by_topic(self, topic_id):
+        """按话题 ID 查找，返回 (session_id, record)，找不到时返回 (None, None)"""
+
+    @abstractmethod
+    def put(self, session_id, topic_id, message_id=None, enable_ai=False):
+        """新增或更新会话的话题映射，已有的 completed 状态保持不变"""
+
+    @abstractmethod
+    def update(self, session_id, **fields):
+        """更新会话的部分字段，会话不存在时忽略"""
+
+    @abstractmethod
+    def delete(self, session_id):
+        """删除会话记录"""
+
+    @abstractmethod
+    def all(self):
+        """返回全部会话 {session_id: record}"""
+
+    @abstractmethod
+    def load_history(self, session_id):
+        """读取会话的 AI 对话记录，返回 [(role, content), ...]"""
+
+    @abstractmethod
+    def save_histories(self, histories):
+        """批量保存 AI 对话记录，histories 为 {session_id: [(role, content), ...]}，值为 None 时删除"""
+
+    @abstractmethod
+    def count(self):
+        """会话总数"""
+
+    def close(self):
+        pass
+
+
+class SqliteSessionStore(SessionStore):
+    """基于 SQLite（WAL 模式）的会话存储，每次写入都是一个独立事务"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " session_id TEXT PRIMARY KEY,"
+            " topic_id INTEGER,"
+            " message_id INTEGER,"
+            " enable_ai INTEGER NOT NULL DEFAULT 0,"
+            " completed INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_topic ON sessions (topic_id)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS histories (session_id TEXT PRIMARY KEY, turns TEXT NOT NULL)"
+        )
+
+    @staticmethod
+    def _row(row):
+        return {
+            'topic_id': row[0],
+            'message_id': row[1],
+            'enable_ai': bool(row[2]),
+            'completed': bool(row[3])
+        }
+
+    def get(self, session_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT topic_id, message_id, enable_ai, completed FROM sessions WHERE session_id = ?",
+                (session_id,)
+            ).fetchone()
+        return self._row(row) if row else None
+
+    def get_by_topic(self, topic_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT topic_id, message_id, enable_ai, completed, session_id FROM sessions WHERE topic_id = ?",
+                (topic_id,)
+            ).fetchone()
+        return (row[4], self._row(row)) if row else (None, None)
+
+    def put(self, session_id, topic_id, message_id=None, enable_ai=False):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sessions (session_id, topic_id, message_id, enable_ai) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(session_id) DO UPDATE SET"
+                " topic_id = excluded.topic_id, message_id = excluded.message_id, enable_ai = excluded.enable_ai",
+                (session_id, topic_id, message_id, int(bool(enable_ai)))
+            )
+
+    def update(self, session_id, **fields):
+        fields = {key: value for key, value in fields.items() if key in FIELDS}
+        if not fields:
+            return
+        columns = ', '.join(f"{key} = ?" for key in fields)
+        values = [int(value) if isinstance(value, bool) else value for value in fields.values()]
+        with self._lock:
+            self._conn.execute(f"UPDATE sessions SET {columns} WHERE session_id = ?", (*values, session_id))
+
+    def delete(self, session_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def put_many(self, mapping):
+        """在一个事务中批量写入，用于迁移"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO sessions (session_id, topic_id, message_id, enable_ai, completed)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (
+                            session_id,
+                            data['topic_id'],
+                            data.get('message_id'),
+                            int(bool(data.get('enable_ai', False))),
+                            int(bool(data.get('completed', False)))
+                        )
+                        for session_id, data in mapping.items()
+                    ]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def all(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT topic_id, message_id, enable_ai, completed, session_id FROM sessions"
+            ).fetchall()
+        return {row[4]: self._row(row) for row in rows}
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def load_history(self, session_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT turns FROM histories WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return [tuple(turn) for turn in json.loads(row[0])] if row else []
+
+    def save_histories(self, histories):
+        saved = [
+            (session_id, json.dumps(list(turns), ensure_ascii=False))
+            for session_id, turns in histories.items() if turns
+        ]
+        deleted = [(session_id,) for session_id, turns in histories.items() if not turns]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO histories (session_id, turns) VALUES (?, ?)", saved)
+                self._conn.executemany("DELETE FROM histories WHERE session_id = ?", deleted)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class JournalSessionStore(SessionStore):
+    """仅追加写入的日志式会话存储
+
+    每次变更追加一行 JSON 并 fsync（批量写入时整批只 fsync 一次），启动时回放日志重建内存索引；
+    日志中的无效行（例如崩溃时写了一半的最后一行）会被忽略，
+    日志行数远超会话数时（启动时以及运行过程中）自动压缩（写入临时文件后原子替换）。
+    """
+
+    def __init__(self, path, fsync=True):
+        self._path = path
+        self._fsync = fsync
+        self._lock = threading.Lock()
+        self._records = {}
+        self._by_topic = {}
+        self._histories = {}
+        self._lines = 0
+        self._replay()
+        if self._needs_compaction():
+            self._compact()
+        self._file = open(self._path, 'a', encoding='utf-8')
+
+    def _needs_compaction(self):
+        return self._lines > 2 * (len(self._records) + len(self._histories)) + 1000
+
+    def _replay(self):
+        try:
+            with open(self._path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._apply(entry)
+                    self._lines += 1
+        except FileNotFoundError:
+            pass
+
+    def _apply(self, entry):
+        op = entry.get('op')
+        session_id = entry.get('id')
+        if op == 'put':
+            record = self._records.get(session_id, dict(FIELDS))
+            old_topic = record.get('topic_id')
+            if old_topic is not None and self._by_topic.get(old_topic) == session_id:
+                del self._by_topic[old_topic]
+            record.update({key: entry[key] for key in FIELDS if key in entry})
+            self._records[session_id] = record
+            self._by_topic[record['topic_id']] = session_id
+        elif op == 'update' and session_id in self._records:
+            self._records[session_id].update({key: entry[key] for key in FIELDS if key in entry})
+        elif op == 'delete':
+            record = self._records.pop(session_id, None)
+            if record is not None and self._by_topic.get(record['topic_id']) == session_id:
+                del self._by_topic[record['topic_id']]
+            self._histories.pop(session_id, None)
+        elif op == 'history':
+            if entry.get('turns'):
+                self._histories[session_id] = [tuple(turn) for turn in entry['turns']]
+            else:
+                self._histories.pop(session_id, None)
+
+    def _append(self, *entries):
+        with self._lock:
+            for entry in entries:
+                self._apply(entry)
+                self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._file.flush()
+            if self._fsync:
+                os.fsync(self._file.fileno())
+            self._lines += len(entries)
+            if self._needs_compaction():
+                self._file.close()
+                self._compact()
+                self._file = open(self._path, 'a', encoding='utf-8')
+
+    def _compact(self):
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for session_id, record in self._records.items():
+                f.write(json.dumps({'op': 'put', 'id': session_id, **record}, ensure_ascii=False) + '\n')
+            for session_id, turns in self._histories.items():
+                f.write(json.dumps({'op': 'history', 'id': session_id, 'turns': turns}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self._path)
+        self._lines = len(self._records) + len(self._histories)
+
+    def get(self, session_id):
+        record = self._records.get(session_id)
+        return dict(record) if record else None
+
+    def get_by_topic(self, topic_id):
+        session_id = self._by_topic.get(topic_id)
+        if session_id is None:
+            return None, None
+        return session_id, self.get(session_id)
+
+    def put(self, session_id, topic_id, message_id=None, enable_ai=False):
+        self._append({
+            'op': 'put',
+            'id': session_id,
+            'topic_id': topic_id,
+            'message_id': message_id,
+            'enable_ai': bool(enable_ai)
+        })
+
+    def update(self, session_id, **fields):
+        fields = {key: value for key, value in fields.items() if key in FIELDS}
+        if fields and session_id in self._records:
+            self._append({'op': 'update', 'id': session_id, **fields})
+
+    def delete(self, session_id):
+        if session_id in self._records:
+            self._append({'op': 'delete', 'id': session_id})
+
+    def put_many(self, mapping):
+        entries = [
+            {
+                'op': 'put',
+                'id': session_id,
+                **{key: data.get(key, default) for key, default in FIELDS.items()}
+            }
+            for session_id, data in mapping.items()
+        ]
+        if entries:
+            self._append(*entries)
+
+    def all(self):
+        return {session_id: dict(record) for session_id, record in self._records.items()}
+
+    def count(self):
+        return len(self._records)
+
+    def load_history(self, session_id):
+        return list(self._histories.get(session_id, []))
+
+    def save_histories(self, histories):
+        entries = [
+            {'op': 'history', 'id': session_id, 'turns': list(turns) if turns else []}
+            for session_id, turns in histories.items()
+            if turns or session_id in self._histories
+        ]
+        if entries:
+            self._append(*entries)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def open_store(store_config):
+    """根据配置创建会话存储
+
+    Args:
+        store_config: 配置中的 session_store 部分，backend 可选 sqlite（默认）或 journal
+    """
+    backend = store_config.get('backend', 'sqlite')
+    if backend == 'journal':
+        path = store_config.get('path', 'data/sessions.journal')
+    else:
+        path = store_config.get('path', 'data/sessions.db')
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if backend == 'journal':
+        return JournalSessionStore(path, fsync=store_config.get('fsync', True))
+    if backend != 'sqlite':
+        logging.warning(f"未知的会话存储类型 {backend}，使用 sqlite")
+    return SqliteSessionStore(path)
+
+
+def migrate_yaml(store, mapping_file='session_mapping.yml'):
+    """将旧的 session_mapping.yml 一次性导入到空的会话存储中
+
+    Returns:
+        导入的会话数量
+    """
+    if store.count() > 0:
+        return 0
+    try:
+        with open(mapping_file, 'r', encoding='utf-8') as f:
+            mapping = yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        return 0
+
+    cleaned_mapping = {
+        session_id: data for session_id, data in mapping.items()
+        if isinstance(data, dict) and 'topic_id' in data
+    }
+    if cleaned_mapping:
+        store.put_many(cleaned_mapping)
+        logging.info(f"已从 {mapping_file} 迁移 {len(cleaned_mapping)} 条会话映射")
+    return len(cleaned_mapping)
@@ -0,0 +1,162 @@
+import logging
+from collections import OrderedDict
+
+
+class SessionIndex:
+    """会话双向索引：session_id ⇄ topic_id
+
+    所有查询均为 O(1)，未命中时直接返回 None，不会回退去读取映射文件。
+    只在事件循环线程中使用，无需加锁。
+    """
+
+    def __init__(self):
+        self._topic_by_session = {}
+        self._session_by_topic = {}
+
+    def bind(self, session_id, topic_id):
+        """登记（或更新）一个会话的话题"""
+        old_topic = self._topic_by_session.get(session_id)
+        if old_topic is not None and old_topic != topic_id:
+            self._session_by_topic.pop(old_topic, None)
+        self._topic_by_session[session_id] = topic_id
+        self._session_by_topic[topic_id] = session_id
+
+    def unbind(self, session_id):
+        """从索引中移除一个会话"""
+        topic_id = self._topic_by_session.pop(session_id, None)
+        if topic_id is not None:
+            self._session_by_topic.pop(topic_id, None)
+
+    def session_by_topic(self, topic_id):
+        return self._session_by_topic.get(topic_id)
+
+    def topic_of(self, session_id):
+        return self._topic_by_session.get(session_id)
+
+    def __contains__(self, session_id):
+        return session_id in self._topic_by_session
+
+    def __len__(self):
+        return len(self._topic_by_session)
+
+
+class SessionRecord:
+    """常驻内存的会话记录
+
+    topic_id / message_id / enable_ai / completed 会持久化到会话存储，
+    first_message / button_sent 只在内存中保存，会话被淘汰或重启后恢复为默认值。
+    """
+
+    __slots__ = ('session_id', 'topic_id', 'message_id', 'enable_ai', 'completed', 'first_message', 'button_sent')
+
+    PERSISTENT = ('topic_id', 'message_id', 'enable_ai', 'completed')
+
+    def __init__(self, session_id, topic_id, message_id=None, enable_ai=False, completed=False,
+                 first_message=False, button_sent=False):
+        self.session_id = session_id
+        self.topic_id = topic_id
+        self.message_id = message_id
+        self.enable_ai = enable_ai
+        self.completed = completed
+        self.first_message = first_message
+        self.button_sent = button_sent
+
+
+class SessionRegistry:
+    """有容量上限的会话注册表
+
+    只在内存中保留最近活跃的 max_resident 个会话（LRU 淘汰），
+    其余会话在按会话 ID 或话题 ID 访问时再从会话存储中读取，启动时无需加载全部映射。
+
+    Args:
+        store: 会话存储（SessionStore）
+        max_resident: 内存中保留的会话数上限
+    """
+
+    def __init__(self, store, max_resident=1000):
+        self._store = store
+        self.max_resident = max_resident
+        self._records = OrderedDict()
+        self._index = SessionIndex()
+        self.stats = {'hits': 0, 'faults': 0, 'misses': 0, 'evictions': 0}
+
+    def _admit(self, record):
+        self._records[record.session_id] = record
+        self._records.move_to_end(record.session_id)
+        self._index.bind(record.session_id, record.topic_id)
+        while len(self._records) > self.max_resident:
+            session_id, _ = self._records.popitem(last=False)
+            self._index.unbind(session_id)
+            self.stats['evictions'] += 1
+        return record
+
+    def _fault(self, session_id, data):
+        self.stats['faults'] += 1
+        return self._admit(SessionRecord(
+            session_id,
+            data['topic_id'],
+            message_id=data.get('message_id'),
+            enable_ai=data.get('enable_ai', False),
+            completed=data.get('completed', False)
+        ))
+
+    def get(self, session_id):
+        """按会话 ID 获取记录，不在内存中时从存储读取，都没有时返回 None"""
+        record = self._records.get(session_id)
+        if record is not None:
+            self._records.move_to_end(session_id)
+            self.stats['hits'] += 1
+            return record
+        try:
+            data = self._store.get(session_id)
+        except Exception as e:
+            logging.error(f"读取会话 {session_id} 失败: {str(e)}")
+            return None
+        if not data or data.get('topic_id') is None:
+            self.stats['misses'] += 1
+            return None
+        return self._fault(session_id, data)
+
+    def by_topic(self, topic_id):
+        """按话题 ID 获取记录，不在内存中时从存储读取"""
+        session_id = self._index.session_by_topic(topic_id)
+        if session_id is not None:
+            return self.get(session_id)
+        try:
+            session_id, data = self._store.get_by_topic(topic_id)
+        except Exception as e:
+            logging.error(f"按话题 {topic_id} 读取会话失败: {str(e)}")
+            return None
+        if session_id is None:
+            self.stats['misses'] += 1
+            return None
+        return self._fault(session_id, data)
+
+    def create(self, session_id, topic_id, message_id=None, enable_ai=False):
+        """登记新建话题的会话并写入存储"""
+        try:
+            self._store.put(session_id, topic_id, message_id=message_id, enable_ai=enable_ai)
+        except Exception as e:
+            logging.error(f"保存会话映射失败: {str(e)}")
+        return self._admit(SessionRecord(
+            session_id, topic_id, message_id=message_id, enable_ai=enable_ai, first_message=True
+        ))
+
+    def update(self, record, **fields):
+        """修改会话字段，需要持久化的字段同时写入存储"""
+        for name, value in fields.items():
+            setattr(record, name, value)
+        persistent = {name: value for name, value in fields.items() if name in SessionRecord.PERSISTENT}
+        if persistent:
+            try:
+                self._store.update(record.session_id, **persistent)
+            except Exception as e:
+                logging.error(f"更新会话状态失败: {str(e)}")
+        if 'topic_id' in fields and record.session_id in self._records:
+            self._index.bind(record.session_id, record.topic_id)
+
+    def __contains__(self, session_id):
+        return session_id in self._records
+
+    def __len__(self):
+        return len(self._records)
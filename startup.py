@@ -0,0 +1,48 @@
+import asyncio
+import logging
+import time
+
+
+class StartupTimeline:
+    """记录启动过程中各阶段相对进程启动的耗时"""
+
+    def __init__(self):
+        self._started = time.monotonic()
+        self.phases = []
+
+    def mark(self, phase):
+        elapsed = time.monotonic() - self._started
+        self.phases.append((phase, elapsed))
+        logging.info(f"[启动] {phase} (+{elapsed:.2f}s)")
+
+    def summary(self):
+        return ' → '.join(f"{phase} {elapsed:.2f}s" for phase, elapsed in self.phases)
+
+
+async def run_probes(probes):
+    """并行执行启动检查，每项检查有独立的超时时间
+
+    Args:
+        probes: {名称: (协程, 超时秒数)}
+
+    Returns:
+        {名称: 异常}，检查通过的项为 None
+    """
+    async def run(name, coro, timeout):
+        try:
+            await asyncio.wait_for(coro, timeout=timeout)
+            error = None
+        except asyncio.TimeoutError:
+            error = TimeoutError(f"超过 {timeout} 秒未响应")
+        except Exception as e:
+            error = e
+        result = "通过" if error is None else "失败"
+        timeline.mark(f"{name} 检查{result}")
+        return name, error
+
+    results = await asyncio.gather(*(run(name, coro, timeout) for name, (coro, timeout) in probes.items()))
+    return dict(results)
+
+
+# 进程内唯一的启动时间线，bot.py 和 handler.py 共用
+timeline = StartupTimeline()
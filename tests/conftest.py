@@ -0,0 +1,23 @@
+"""测试环境：handler/bot 在导入时读取当前目录下的 config.yml，
+因此在临时目录中写入基于 config.yml.example 的占位配置后再导入。"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+with open(os.path.join(ROOT, 'config.yml.example'), 'r', encoding='utf-8') as f:
+    _config = yaml.safe_load(f)
+_config['bot'].update({'token': '0:placeholder', 'groupId': -100})
+_config['crisp'].update({'id': 'placeholder', 'key': 'placeholder', 'website': 'website'})
+
+_workdir = tempfile.mkdtemp(prefix='crispbot-test-')
+with open(os.path.join(_workdir, 'config.yml'), 'w', encoding='utf-8') as f:
+    yaml.dump(_config, f, allow_unicode=True)
+os.chdir(_workdir)
+atexit.register(shutil.rmtree, _workdir, ignore_errors=True)
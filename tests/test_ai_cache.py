@@ -0,0 +1,30 @@
+import asyncio
+import json
+import os
+
+import ai_cache
+from ai_cache import AnswerCache
+
+
+def test_puts_are_written_in_one_batch_off_the_loop(tmp_path, monkeypatch):
+    path = tmp_path / 'ai_cache.json'
+    cache = AnswerCache('prompt', path=str(path), save_delay=0.05)
+    writes = []
+    real_replace = os.replace
+
+    def replace(src, dst):
+        writes.append(dst)
+        real_replace(src, dst)
+    monkeypatch.setattr(ai_cache.os, 'replace', replace)
+
+    async def scenario():
+        for i in range(10):
+            cache.put(f"问题 {i}", f"回复 {i}")
+        # 写入在 save_delay 之后进行，put 本身不触碰磁盘
+        assert not path.exists()
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+    assert writes == [str(path)]
+    assert len(json.loads(path.read_text(encoding='utf-8'))) == 10
+    assert AnswerCache('prompt', path=str(path)).get('问题 3？') == '回复 3'
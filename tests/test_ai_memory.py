@@ -0,0 +1,59 @@
+import asyncio
+
+from ai_memory import ConversationMemory
+from session_store import JournalSessionStore
+
+
+def journal_lines(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read().splitlines()
+
+
+def test_turns_are_written_in_one_batch(tmp_path):
+    path = str(tmp_path / 'sessions.journal')
+    store = JournalSessionStore(path, fsync=False)
+    memory = ConversationMemory(store, max_turns=4, flush_delay=0.01)
+
+    async def scenario():
+        for i in range(3):
+            memory.append('session', 'user', f'问题 {i}')
+            memory.append('session', 'assistant', f'回复 {i}')
+        # 写入前仍可以从内存中读到完整记录
+        assert len(journal_lines(path)) == 0
+        await asyncio.sleep(0.05)
+        await memory._flush_task
+
+    asyncio.run(scenario())
+    assert len(journal_lines(path)) == 1
+    assert store.load_history('session')[-1] == ('assistant', '回复 2')
+    assert len(store.load_history('session')) == 4
+
+
+def test_evicted_session_keeps_unwritten_turns(tmp_path):
+    store = JournalSessionStore(str(tmp_path / 'sessions.journal'), fsync=False)
+    memory = ConversationMemory(store, max_sessions=1, flush_delay=60)
+
+    async def scenario():
+        memory.append('a', 'user', '你好')
+        memory.append('b', 'user', '在吗')
+        # a 已被 LRU 淘汰且尚未写入存储
+        history = memory.messages('a', 'system', '问题')
+        await memory.flush()
+        memory._flush_handle.cancel()
+        return history
+
+    history = asyncio.run(scenario())
+    assert {'role': 'user', 'content': '你好'} in history
+    assert store.load_history('a') == [('user', '你好')]
+
+
+def test_journal_compacts_at_runtime(tmp_path):
+    path = str(tmp_path / 'sessions.journal')
+    store = JournalSessionStore(path, fsync=False)
+    store.put('session', 1)
+    for i in range(1500):
+        store.save_histories({'session': [('user', str(i))]})
+    assert len(journal_lines(path)) < 1100
+    reopened = JournalSessionStore(path, fsync=False)
+    assert reopened.load_history('session') == [('user', '1499')]
+    assert reopened.get('session')['topic_id'] == 1
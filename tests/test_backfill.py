@@ -0,0 +1,36 @@
+import asyncio
+import time
+
+from backfill import GapBackfill
+
+
+class FakeCrisp:
+    def __init__(self, messages):
+        self.messages = messages
+
+    async def list_conversations(self, website_id, page, query):
+        return []
+
+    async def get_messages_in_conversation(self, website_id, session_id, query=None):
+        if query:
+            return []
+        return [message for message in self.messages if message["session_id"] == session_id]
+
+
+def test_known_session_resumes_after_last_seen_message():
+    now = int(time.time() * 1000)
+    delivered = {"session_id": "s", "from": "user", "fingerprint": 1, "timestamp": now - 10000}
+    missed = {"session_id": "s", "from": "user", "fingerprint": 2, "timestamp": now - 5000}
+    forwarded = []
+
+    def forward(event):
+        forwarded.append(event["fingerprint"])
+        return True
+
+    backfill = GapBackfill(FakeCrisp([delivered, missed]), "website", forward, grace=30)
+    backfill.seen(delivered)
+    # 断线时间晚于已送达的消息，但 grace 范围覆盖了它
+    backfill._disconnected_at = now - 8000
+    asyncio.run(backfill.run())
+
+    assert forwarded == [2]
@@ -0,0 +1,28 @@
+import asyncio
+
+from card_refresh import CardRefresher
+
+
+def test_state_is_bounded_and_unchanged_cards_are_skipped():
+    edits = []
+
+    async def render(session_id):
+        return f"card {session_id}", None
+
+    async def edit(session_id, text, reply_markup):
+        edits.append(session_id)
+        return True
+
+    refresher = CardRefresher(render, edit, window=0, max_sessions=2)
+
+    async def scenario():
+        for session_id in ('a', 'b', 'c'):
+            refresher.refresh(session_id)
+            await refresher.join()
+        refresher.refresh('c')
+        await refresher.join()
+
+    asyncio.run(scenario())
+    assert edits == ['a', 'b', 'c']
+    assert refresher.stats['sent'] == 3 and refresher.stats['skipped'] == 1
+    assert len(refresher._hashes) == 2
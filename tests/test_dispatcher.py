@@ -0,0 +1,68 @@
+import asyncio
+
+from dispatcher import SessionDispatcher
+
+
+def test_events_of_one_session_are_processed_in_order():
+    handled = []
+
+    async def handle(event):
+        session_id, seq = event
+        # 越早的事件处理越慢，乱序处理时顺序会颠倒
+        await asyncio.sleep(0.01 * (5 - seq))
+        handled.append(event)
+
+    async def scenario():
+        dispatcher = SessionDispatcher(handle, max_concurrency=10)
+        for seq in range(5):
+            for session_id in ('a', 'b'):
+                dispatcher.submit(session_id, (session_id, seq))
+        await asyncio.sleep(0.3)
+
+    asyncio.run(scenario())
+    for session_id in ('a', 'b'):
+        assert [seq for sid, seq in handled if sid == session_id] == list(range(5))
+
+
+def test_concurrency_is_capped_across_sessions():
+    running = 0
+    peak = 0
+
+    async def handle(event):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.02)
+        running -= 1
+
+    async def scenario():
+        dispatcher = SessionDispatcher(handle, max_concurrency=3)
+        for i in range(10):
+            dispatcher.submit(f"session_{i}", i)
+        await asyncio.sleep(0.2)
+
+    asyncio.run(scenario())
+    assert peak == 3
+
+
+def test_idle_workers_are_reaped():
+    handled = []
+
+    async def handle(event):
+        handled.append(event)
+
+    async def scenario():
+        dispatcher = SessionDispatcher(handle, idle_timeout=0.05)
+        dispatcher.submit('a', 1)
+        await asyncio.sleep(0.01)
+        assert dispatcher.active_workers == 1
+        await asyncio.sleep(0.1)
+        assert dispatcher.active_workers == 0 and dispatcher.stats() == {}
+
+        # 回收后的会话收到新事件时重新创建工作协程
+        dispatcher.submit('a', 2)
+        await asyncio.sleep(0.01)
+        assert dispatcher.active_workers == 1
+
+    asyncio.run(scenario())
+    assert handled == [1, 2]
@@ -0,0 +1,74 @@
+import asyncio
+import json
+
+import pytest
+
+import image_upload
+from http_client import HttpResponse, HttpStatusError
+from image_upload import ImageUploader, UploadCache
+
+GIF = b'GIF89a\x01\x00\x01\x00\x00\x00\x00;'
+
+
+class FakeHttp:
+    """imgbb 返回 500，sang_pub 正常返回链接"""
+
+    def __init__(self):
+        self.urls = []
+
+    async def request(self, method, url, **kwargs):
+        self.urls.append(url)
+        if 'imgbb' in url:
+            return HttpResponse(500, {}, b'{"error": "internal"}', url)
+        return HttpResponse(200, {}, b'https://file.sang.pub/image.gif', url)
+
+
+def uploader(http, mode):
+    return ImageUploader({
+        'mode': mode,
+        'imgbb_api_key': 'key',
+        'enabled_services': {'imgbb': True, 'sang_pub': True},
+        'preprocess': {'max_dimension': 0, 'max_bytes': 0}
+    }, http)
+
+
+@pytest.mark.parametrize('mode', ['sequential', 'race'])
+def test_falls_back_when_first_host_fails(mode):
+    http = FakeHttp()
+    image_url = asyncio.run(uploader(http, mode).upload(GIF))
+    assert image_url == 'https://file.sang.pub/image.gif'
+    assert any('imgbb' in url for url in http.urls)
+
+
+def test_status_error_is_printable():
+    response = HttpResponse(502, {}, b'bad gateway', 'https://example.com/upload')
+    with pytest.raises(HttpStatusError) as info:
+        response.raise_for_status()
+    assert info.value.status == 502
+    assert '502' in str(info.value)
+
+
+def test_upload_cache_index_is_written_after_delay(tmp_path):
+    path = tmp_path / 'upload_cache.json'
+    cache = UploadCache(path=str(path), save_delay=0.05)
+
+    async def scenario():
+        for i in range(5):
+            cache.put(f"https://example.com/{i}.png", file_unique_id=f"file_{i}", digest=f"digest_{i}")
+        # put 不在事件循环中写文件，索引在 save_delay 之后批量写入
+        assert not path.exists()
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+    index = json.loads(path.read_text(encoding='utf-8'))
+    assert len(index['files']) == 5 and len(index['digests']) == 5
+    assert UploadCache(path=str(path)).get_by_digest('digest_2') == 'https://example.com/2.png'
+
+
+def test_upload_cache_skips_expired_links(monkeypatch):
+    monkeypatch.setattr(image_upload.time, 'time', lambda: 1000.0)
+    cache = UploadCache(ttl=10)
+    # 内容缓存中的链接恰好在此刻到期
+    cache._digests.set('digest', ('https://example.com/old.png', 990.0))
+    cache.put('https://example.com/old.png', file_unique_id='file', digest='digest')
+    assert cache.get_by_file_id('file') is None
@@ -0,0 +1,122 @@
+import asyncio
+
+import telegram
+
+from outbound import PRIORITY_CARD, PRIORITY_PREVIEW, PRIORITY_VISITOR, OutboundScheduler
+
+
+class Recorder:
+    """记录发送顺序，返回调用参数"""
+
+    __name__ = 'record'
+
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, value):
+        self.calls.append(value)
+        return value
+
+
+def throttled():
+    # 首个请求用掉唯一的令牌，之后每 0.05 秒补充一个，后续请求都要先排队
+    return OutboundScheduler(chat_rate=1, chat_period=0.05, chat_burst=1)
+
+
+class FlakyMethod:
+    """前 failures 次调用返回 429，之后返回调用参数"""
+
+    __name__ = 'flaky'
+
+    def __init__(self, failures=1, retry_after=0.1):
+        self.failures = failures
+        self.retry_after = retry_after
+        self.calls = []
+        self.limited = asyncio.Event()
+
+    async def __call__(self, value):
+        self.calls.append(value)
+        if self.failures > 0:
+            self.failures -= 1
+            self.limited.set()
+            raise telegram.error.RetryAfter(self.retry_after)
+        return value
+
+
+def test_jobs_are_sent_by_priority():
+    async def scenario():
+        scheduler = throttled()
+        method = Recorder()
+        await scheduler.call(1, method, 'first')
+        return await asyncio.gather(
+            scheduler.call(1, method, 'card', priority=PRIORITY_CARD),
+            scheduler.call(1, method, 'preview', priority=PRIORITY_PREVIEW),
+            scheduler.call(1, method, 'visitor', priority=PRIORITY_VISITOR),
+        ), method
+
+    results, method = asyncio.run(scenario())
+    assert results == ['card', 'preview', 'visitor']
+    assert method.calls == ['first', 'visitor', 'preview', 'card']
+
+
+def test_stale_jobs_are_dropped():
+    async def scenario():
+        scheduler = throttled()
+        method = Recorder()
+        await scheduler.call(1, method, 'first')
+        results = await asyncio.gather(
+            scheduler.call(1, method, 'stale', stale_after=0.01),
+            scheduler.call(1, method, 'fresh'),
+        )
+        return scheduler, method, results
+
+    scheduler, method, results = asyncio.run(scenario())
+    assert results == [None, 'fresh']
+    assert method.calls == ['first', 'fresh']
+    assert scheduler.stats['stale'] == 1
+
+
+def test_queued_job_is_superseded_by_same_key():
+    async def scenario():
+        scheduler = throttled()
+        method = Recorder()
+        await scheduler.call(1, method, 'first')
+        results = await asyncio.gather(
+            scheduler.call(1, method, 'old', key='card'),
+            scheduler.call(1, method, 'new', key='card'),
+        )
+        return scheduler, method, results
+
+    scheduler, method, results = asyncio.run(scenario())
+    assert results == [None, 'new']
+    assert method.calls == ['first', 'new']
+    assert scheduler.stats['superseded'] == 1
+
+
+def test_retry_after_requeue_resets_deadline():
+    async def scenario():
+        scheduler = OutboundScheduler(chat_rate=100, chat_period=1)
+        method = FlakyMethod(retry_after=0.2)
+        # 限流时间超过 stale_after，过期时间应从恢复发送时重新计算
+        result = await scheduler.call(1, method, 'card', stale_after=0.1)
+        return scheduler, method, result
+
+    scheduler, method, result = asyncio.run(scenario())
+    assert result == 'card'
+    assert method.calls == ['card', 'card']
+    assert scheduler.stats['retried'] == 1 and scheduler.stats['stale'] == 0
+
+
+def test_retry_after_requeue_can_be_superseded():
+    async def scenario():
+        scheduler = OutboundScheduler(chat_rate=100, chat_period=1)
+        method = FlakyMethod(retry_after=0.1)
+        old = asyncio.create_task(scheduler.call(1, method, 'old', key='card'))
+        await method.limited.wait()
+        new = await scheduler.call(1, method, 'new', key='card')
+        return scheduler, method, await old, new
+
+    scheduler, method, old, new = asyncio.run(scenario())
+    assert (old, new) == (None, 'new')
+    assert method.calls == ['old', 'new']
+    assert scheduler.stats['superseded'] == 1
@@ -0,0 +1,98 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import handler
+from card_refresh import CardRefresher
+from outbound import OutboundScheduler
+
+
+class StubBot:
+    """只记录调用参数的 Bot，参数签名与 Bot API 方法一致"""
+
+    def __init__(self):
+        self.calls = []
+        self._next_id = 100
+
+    def _id(self):
+        self._next_id += 1
+        return self._next_id
+
+    async def create_forum_topic(self, chat_id, name, icon_color=None):
+        self.calls.append(('create_forum_topic', chat_id, name))
+        return SimpleNamespace(message_thread_id=self._id())
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append(('send_message', chat_id, kwargs.get('message_thread_id')))
+        return SimpleNamespace(message_id=self._id())
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.calls.append(('edit_message_text', chat_id, message_id))
+        return SimpleNamespace(message_id=message_id)
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    stub = StubBot()
+    monkeypatch.setattr(handler, 'callbackContext', SimpleNamespace(bot=stub), raising=False)
+    # 每个测试使用独立的调度器，避免调度任务绑定到已关闭的事件循环
+    monkeypatch.setattr(handler, 'outbound', OutboundScheduler())
+
+    async def getMetas(session_id):
+        return f"*Crisp消息推送* {session_id}"
+    monkeypatch.setattr(handler, 'getMetas', getMetas)
+    return stub
+
+
+def test_create_session_and_edit_card(bot):
+    session_id = 'session_outbound_test'
+    data = {"session_id": session_id, "user": {"nickname": "访客"}}
+
+    async def scenario():
+        await handler.createSession(data)
+        session = handler.session_registry.get(session_id)
+        assert session is not None
+        result = await handler.editCard(session_id, "新的卡片", handler.changeButton(session_id, True))
+        return session, result
+
+    session, result = asyncio.run(scenario())
+
+    group_id = handler.groupId
+    assert bot.calls[0] == ('create_forum_topic', group_id, '访客')
+    assert bot.calls[1] == ('send_message', group_id, session.topic_id)
+    assert bot.calls[2] == ('edit_message_text', group_id, session.message_id)
+    assert result is True
+    assert handler.outbound.stats['sent'] == 3
+
+
+def test_card_refresh_does_not_delay_visitor_message(bot, monkeypatch):
+    # 群组每 0.05 秒只补充一个令牌，卡片编辑和访客消息必然同时排队
+    monkeypatch.setattr(handler, 'outbound', OutboundScheduler(chat_rate=1, chat_period=0.05, chat_burst=1))
+    monkeypatch.setattr(handler, 'card_refresher', CardRefresher(handler.renderCard, handler.editCard, window=0))
+    session_id = 'session_priority_test'
+    data = {"session_id": session_id, "user": {"nickname": "访客"}}
+
+    async def scenario():
+        await handler.createSession(data)
+        session = handler.session_registry.get(session_id)
+        del bot.calls[:]
+
+        async def getMetas(session_id):
+            return f"*Crisp消息推送* {session_id} 已更新"
+        monkeypatch.setattr(handler, 'getMetas', getMetas)
+
+        # 已有会话：createSession 只请求刷新卡片，随后转发访客消息
+        await handler.createSession(data)
+        await handler.outbound.call(handler.groupId, bot.send_message, handler.groupId, "访客消息",
+                                    message_thread_id=session.topic_id)
+        await handler.card_refresher.join()
+        return session
+
+    session = asyncio.run(scenario())
+
+    group_id = handler.groupId
+    assert bot.calls == [
+        ('send_message', group_id, session.topic_id),
+        ('edit_message_text', group_id, session.message_id),
+    ]
@@ -0,0 +1,56 @@
+import asyncio
+
+from rtm_supervisor import RTMSupervisor
+
+
+class FlappingSocket:
+    """每次连接都成功，但连接后立即被服务器断开"""
+
+    def __init__(self):
+        self.connected = False
+        self.connects = 0
+
+    async def connect(self, url, **kwargs):
+        self.connects += 1
+        self.connected = True
+
+    async def wait(self):
+        self.connected = False
+
+    async def disconnect(self):
+        self.connected = False
+
+
+def test_backoff_grows_when_connection_drops_immediately():
+    sio = FlappingSocket()
+    notices = []
+
+    async def resolve():
+        return 'wss://example.com'
+
+    async def on_connected(outage):
+        notices.append(outage)
+
+    supervisor = RTMSupervisor(sio, resolve, on_connected=on_connected, backoff=0.01, max_backoff=0.08,
+                               heartbeat_interval=60, min_uptime=30)
+    delays = []
+    original = supervisor._delay
+
+    def record():
+        delay = original()
+        delays.append(delay)
+        return delay
+    supervisor._delay = record
+
+    async def scenario():
+        task = asyncio.create_task(supervisor.run())
+        await asyncio.sleep(0.3)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(scenario())
+    # 每次断开后都会退避，且退避时间逐渐增长直到上限
+    assert len(delays) >= sio.connects - 1
+    assert delays[3] > delays[0]
+    assert sio.connects < 10
+    assert len(notices) == sio.connects
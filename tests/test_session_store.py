@@ -0,0 +1,29 @@
+import os
+
+import session_store
+from session_store import JournalSessionStore
+
+
+def test_journal_put_many_syncs_once(tmp_path, monkeypatch):
+    fsyncs = []
+    real_fsync = os.fsync
+
+    def fsync(fd):
+        fsyncs.append(fd)
+        real_fsync(fd)
+    monkeypatch.setattr(session_store.os, 'fsync', fsync)
+
+    path = str(tmp_path / 'sessions.journal')
+    store = JournalSessionStore(path)
+    store.put_many({
+        f"session_{i}": {'topic_id': i, 'message_id': 100 + i, 'completed': i % 2 == 0}
+        for i in range(50)
+    })
+    store.close()
+    assert len(fsyncs) == 1
+
+    store = JournalSessionStore(path)
+    assert store.count() == 50
+    assert store.get('session_3') == {'topic_id': 3, 'message_id': 103, 'enable_ai': False, 'completed': False}
+    assert store.get('session_4')['completed'] is True
+    store.close()
@@ -0,0 +1,201 @@
+import asyncio
+import contextvars
+import cProfile
+import functools
+import heapq
+import io
+import itertools
+import logging
+import pstats
+import secrets
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from metrics import STAGE_SECONDS
+
+# 当前协程所属的追踪，asyncio 创建的子任务会继承
+_current = contextvars.ContextVar('crispbot_trace', default=None)
+
+
+class Trace:
+    """一条消息的处理时间线：每个阶段记录相对开始时间的偏移、耗时和异常类型"""
+
+    __slots__ = ('trace_id', 'kind', 'attrs', 'started_at', 'wall_started', 'duration', 'spans')
+
+    def __init__(self, kind, **attrs):
+        self.trace_id = secrets.token_hex(8)
+        self.kind = kind
+        self.attrs = attrs
+        self.started_at = time.monotonic()
+        self.wall_started = time.time()
+        self.duration = None
+        self.spans = []
+
+    def add(self, name, started, duration, error=None):
+        """记录一个阶段，started 为 time.monotonic() 时间"""
+        self.spans.append((started - self.started_at, duration, name, error))
+
+    def finish(self):
+        self.duration = time.monotonic() - self.started_at
+
+    def render(self):
+        attrs = ' '.join(f"{key}={value}" for key, value in self.attrs.items())
+        started = datetime.fromtimestamp(self.wall_started).strftime('%Y-%m-%d %H:%M:%S')
+        lines = [f"[{self.trace_id}] {self.kind} {attrs} 开始于 {started}，总耗时 {self.duration * 1000:.1f} ms"]
+        for offset, duration, name, error in sorted(self.spans, key=lambda span: span[0]):
+            suffix = f"  ✗ {error}" if error else ""
+            lines.append(f"  +{offset * 1000:9.1f} ms {duration * 1000:9.1f} ms  {name}{suffix}")
+        return '\n'.join(lines)
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def span(name, trace=None):
+    """在当前追踪中记录一个阶段，没有正在进行的追踪时不做任何事"""
+    trace = trace or _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.monotonic()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        trace.add(name, started, time.monotonic() - started, error)
+
+
+def stage(name):
+    """处理阶段装饰器：记录追踪中的阶段，同时计入 crispbot_stage_seconds 指标"""
+    def decorator(func):
+        timer = STAGE_SECONDS.timed(stage=name)
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return timer(async_wrapper)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return timer(wrapper)
+    return decorator
+
+
+class Tracer:
+    """保留耗时最长的 size 条追踪
+
+    Args:
+        size: 保留的追踪条数
+        slow_threshold: 总耗时超过该秒数时输出警告日志，0 表示不输出
+    """
+
+    def __init__(self, size=20, slow_threshold=0):
+        self.size = size
+        self.slow_threshold = slow_threshold
+        self._slowest = []
+        self._seq = itertools.count()
+        self.total = 0
+
+    def new(self, kind, **attrs):
+        return Trace(kind, **attrs)
+
+    @contextmanager
+    def run(self, trace):
+        """在上下文中激活追踪，结束时记录总耗时"""
+        token = _current.set(trace)
+        try:
+            yield trace
+        finally:
+            _current.reset(token)
+            trace.finish()
+            self._record(trace)
+
+    def trace(self, kind, **attrs):
+        return self.run(self.new(kind, **attrs))
+
+    def _record(self, trace):
+        self.total += 1
+        item = (trace.duration, next(self._seq), trace)
+        if len(self._slowest) < self.size:
+            heapq.heappush(self._slowest, item)
+        elif trace.duration > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, item)
+        if self.slow_threshold and trace.duration > self.slow_threshold:
+            logging.warning(f"处理耗时过长:\n{trace.render()}")
+
+    def slowest(self):
+        return [trace for _, _, trace in sorted(self._slowest, reverse=True)]
+
+    def dump(self):
+        traces = self.slowest()
+        header = f"最慢的 {len(traces)} 条追踪（共记录 {self.total} 条）"
+        return '\n\n'.join([header] + [trace.render() for trace in traces]) + '\n'
+
+    def clear(self):
+        self._slowest.clear()
+
+
+class Profiler:
+    """按需开启的 cProfile 性能分析，超过 max_seconds 自动停止
+
+    Args:
+        max_seconds: 单次分析的最长时间（秒）
+        top: 报告中按累计耗时列出的函数数
+    """
+
+    def __init__(self, max_seconds=60, top=40):
+        self.max_seconds = max_seconds
+        self.top = top
+        self._profile = None
+        self._started_at = None
+        self._timer = None
+
+    @property
+    def running(self):
+        return self._profile is not None
+
+    def elapsed(self):
+        return time.monotonic() - self._started_at if self.running else 0.0
+
+    def start(self, on_timeout=None):
+        """开始分析；on_timeout 为 async (report) -> None，自动停止时调用"""
+        if self.running:
+            return
+        self._profile = cProfile.Profile()
+        self._started_at = time.monotonic()
+        self._profile.enable()
+
+        def timeout():
+            report = self.stop()
+            if on_timeout is not None:
+                asyncio.ensure_future(on_timeout(report))
+
+        self._timer = asyncio.get_running_loop().call_later(self.max_seconds, timeout)
+        logging.info(f"性能分析已开始，最长 {self.max_seconds} 秒")
+
+    def stop(self):
+        """停止分析并返回文本报告，未在分析时返回 None"""
+        if not self.running:
+            return None
+        profile, self._profile = self._profile, None
+        profile.disable()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        duration = time.monotonic() - self._started_at
+        output = io.StringIO()
+        output.write(f"性能分析 {duration:.1f} 秒，按累计耗时排序前 {self.top} 项\n\n")
+        stats = pstats.Stats(profile, stream=output)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        logging.info(f"性能分析已结束，持续 {duration:.1f} 秒")
+        return output.getvalue()